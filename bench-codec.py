@@ -0,0 +1,133 @@
+import sys
+import time
+import uuid
+
+import codec
+
+
+# What the server encodes and decodes for one command of typical traffic.
+usend_command = {
+    "command": "usend",
+    "username": "someone",
+    "message": "Hello there! " * 8,
+    "type": None,
+    "format": None
+}
+
+usend_event = {
+    "event": "message",
+    "uuid": str(uuid.uuid4()),
+    "timestamp": round(time.time()),
+    "origin": 1,
+    "type": None,
+    "username": "me",
+    "format": None,
+    "content": "Hello there! " * 8
+}
+
+uset_command = {
+    "command": "uset",
+    "settings": {
+        "status_text": "doing things",
+        "dnd": True
+    }
+}
+
+uspecial_event = {
+    "event": "uspecial",
+    "settings": {
+        "status_text": "doing things",
+        "dnd": True
+    }
+}
+
+# A user state with a modest social circle, as written back to the database after a uset.
+user_state = {
+    "subscriptions": [f"subscriber{i}" for i in range(50)],
+    "settings": {
+        "name": "Me",
+        "dnd": True,
+        "status_text": "doing things",
+        "description": "x" * 200,
+        "avatar": None,
+        "$creation": round(time.time()),
+        "!channels": [f"channel{i}" for i in range(20)],
+        "!gchannels": [],
+        "!blocked": [f"blocked{i}" for i in range(10)],
+        "!friends": [f"friend{i}" for i in range(200)],
+        "!friendreqs": [],
+        "!subscriptionsto": [f"subscription{i}" for i in range(50)],
+        "!subscriptionstome": [f"subscriber{i}" for i in range(50)],
+        "!privatedsettings": ["description"],
+        "!privatewhitelist": {"description": None},
+        "$bot": False,
+        "perms": [],
+        "&invisible": True,
+        "&asocial": False,
+        "&friends_only": False,
+        "&lone": False,
+        "&skeptic": False,
+        "&friendly": True,
+        "$status": 0,
+        "&pager": None,
+        "&pager_level": 0,
+        "&2fa": False
+    }
+}
+
+
+# Commands arrive as text frames.
+usend_frame = codec.StdlibCodec.encode_text(usend_command)
+uset_frame = codec.StdlibCodec.encode_text(uset_command)
+
+
+def usend(c):
+    "Decode the command, then encode the message event for the recipient."
+
+    c.decode(usend_frame)
+    c.encode_text(usend_event)
+
+def uset(c):
+    "Decode the command, encode the uspecial event and write the user state back."
+
+    c.decode(uset_frame)
+    c.encode_text(uspecial_event)
+    c.encode_text(user_state)
+
+
+def measure(function, c, iterations: int) -> float:
+    "Microseconds per call."
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(c)
+
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"Active codec: {codec.active.name}")
+
+    if (len(codec.codecs) == 1):
+        print("orjson is not installed; only the standard library can be measured.")
+
+    for command in [usend, uset]:
+        results = {
+            name: measure(command, c, iterations) for name, c in codec.codecs.items()
+        }
+
+        line = f"{command.__name__:>6}: " + ", ".join(
+            f"{name} {us:.2f}us" for name, us in results.items()
+        )
+
+        if (codec.OrjsonCodec.name in results):
+            saved = results[codec.StdlibCodec.name] - results[codec.OrjsonCodec.name]
+            line += f" (saves {saved:.2f}us per command)"
+
+        print(line)
+
+
+if (__name__ == "__main__"):
+    main()
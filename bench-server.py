@@ -0,0 +1,413 @@
+import sys
+import time
+import random
+import asyncio
+import subprocess
+import websockets
+
+import codec
+import channels
+import memorydb
+import delegateserver
+
+from util import *
+from definitions import *
+
+
+# The channel every simulated client is a member of, for csend.
+bench_channel = "bench"
+
+# The default mix of commands each simulated client sends, by weight.
+default_mix = {
+    "usend": 50,
+    "uset": 15,
+    "uget": 25,
+    "usubscribe": 5,
+    "frequest": 5
+}
+
+
+class Options:
+    def __init__(self):
+        "Benchmark settings, overridable through the command line."
+
+        self.host: str = "127.0.0.1"
+        self.port: int = 19998
+        self.clients: int = 500
+        self.rate: float = 2.0
+        self.duration: float = 30.0
+        self.setup_concurrency: int = 50
+        self.mix: dict = dict(default_mix)
+        self.output: str = None
+
+
+def percentile(values: list, p: float) -> float:
+    "The p-th percentile of already sorted values, in milliseconds."
+
+    if (values == []):
+        return None
+
+    index = min(len(values) - 1, round(p / 100 * (len(values) - 1)))
+    return round(values[index] * 1000, 3)
+
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99)
+    }
+
+
+class Recorder:
+    def __init__(self):
+        "Collects what every simulated client measures."
+
+        # Seconds from sending a tagged command to its response, by command.
+        self.latencies: dict = {}
+
+        # Responses with a negative (error) code, by command.
+        self.errors: dict = {}
+
+        # Seconds from sending a usend to the recipient receiving the message event.
+        self.lags: list = []
+
+    def response(self, name: str, latency: float, code: int):
+        self.latencies.setdefault(name, []).append(latency)
+
+        if (code < 0):
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, options: Options, elapsed: float) -> dict:
+        completed = sum(len(latencies) for latencies in self.latencies.values())
+
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output = True, text = True
+            ).stdout.strip()
+
+        except OSError:
+            commit = None
+
+        return {
+            "commit": commit,
+            "timestamp": round(time.time()),
+            "options": {
+                "clients": options.clients,
+                "rate": options.rate,
+                "duration": options.duration,
+                "mix": options.mix
+            },
+            "elapsed": round(elapsed, 3),
+            "throughput": round(completed / elapsed, 1),
+            "commands": {
+                name: {**summarize(latencies), "errors": self.errors.get(name, 0)}
+                for name, latencies in self.latencies.items()
+            },
+            "event_lag": summarize(self.lags)
+        }
+
+
+class BenchClient:
+    def __init__(self, number: int, options: Options, recorder: Recorder, usernames: list):
+        "One simulated user, with a command connection and an event connection."
+
+        self.options: Options = options
+        self.recorder: Recorder = recorder
+        self.usernames: list = usernames
+
+        self.username: str = f"bench{number}"
+        self.password: str = f"benchpassword{number}"
+
+        self.ws = None
+        self.events = None
+
+        # Tagged commands waiting for their response: id -> (command, time sent)
+        self.pending: dict = {}
+        self.sequence: int = 0
+        self.subscribed: set = set()
+
+
+    async def request(self, ws, body: dict) -> dict:
+        "Send an untagged command and wait for its response."
+
+        await ws.send(codec.encode_text(body))
+        return codec.decode(await ws.recv())
+
+
+    async def setup(self, uri: str):
+        "Register, then sign in on both connections."
+
+        self.ws = await websockets.connect(uri)
+
+        await self.request(self.ws, {
+            "command": "uregister",
+            "username": self.username,
+            "password": self.password
+        })
+
+        response = await self.request(self.ws, {
+            "command": "user",
+            "username": self.username,
+            "password": self.password,
+            "event": False
+        })
+
+        if (response["code"] != UserCodes.Success.Signin):
+            raise RuntimeError(f"{self.username} could not sign in: {response}")
+
+        self.events = await websockets.connect(uri)
+
+        # The event connection resumes the session, like a real client would.
+        await self.request(self.events, {
+            "command": "user",
+            "username": self.username,
+            "token": response["token"],
+            "event": True
+        })
+
+
+    def other(self) -> str:
+        "Some other simulated user."
+
+        while (username := random.choice(self.usernames)) == self.username:
+            pass
+
+        return username
+
+
+    def build(self, name: str) -> dict:
+        "Make the body of one command."
+
+        if (name == "usend"):
+            # The send time rides along, so the recipient can measure the delivery lag.
+            return {
+                "command": "usend",
+                "username": self.other(),
+                "message": f"bench {time.perf_counter()!r}"
+            }
+
+        if (name == "uset"):
+            return {
+                "command": "uset",
+                "settings": {"status_text": f"status {self.sequence % 1000}"}
+            }
+
+        if (name == "uget"):
+            return {
+                "command": "uget",
+                "username": self.other(),
+                "settings": ["name", "status_text"]
+            }
+
+        if (name == "usubscribe"):
+            username = self.other()
+            subscribe = username not in self.subscribed
+
+            if (subscribe):
+                self.subscribed.add(username)
+            else:
+                self.subscribed.discard(username)
+
+            return {
+                "command": "usubscribe",
+                "username": username,
+                "subscribe": subscribe
+            }
+
+        if (name == "csend"):
+            return {
+                "command": "csend",
+                "channel": bench_channel,
+                "subchannel": "main",
+                "message": f"bench {time.perf_counter()!r}"
+            }
+
+        if (name == "frequest"):
+            return {
+                "command": "frequest",
+                "username": self.other(),
+                "message": "hi"
+            }
+
+        raise KeyError(f"Unknown command in the mix: {name}")
+
+
+    async def read_responses(self):
+        async for message in self.ws:
+            response: dict = codec.decode(message)
+
+            if ((entry := self.pending.pop(response.get("id"), None)) == None):
+                continue
+
+            name, sent = entry
+            self.recorder.response(name, time.perf_counter() - sent, response["code"])
+
+
+    async def read_events(self):
+        async for message in self.events:
+            event: dict = codec.decode(message)
+
+            if (event.get("event") != "message"):
+                continue
+
+            content: str = event.get("content", "")
+            if (content.startswith("bench ")):
+                self.recorder.lags.append(time.perf_counter() - float(content[6:]))
+
+
+    async def run(self, until: float):
+        "Send commands at the configured rate until the given time, without waiting for responses."
+
+        loop = asyncio.get_running_loop()
+        readers = [
+            asyncio.create_task(self.read_responses()),
+            asyncio.create_task(self.read_events())
+        ]
+
+        names = list(self.options.mix.keys())
+        weights = list(self.options.mix.values())
+
+        interval: float = 1 / self.options.rate
+        next_send: float = loop.time() + random.random() * interval
+
+        while (next_send < until):
+            await asyncio.sleep(max(0, next_send - loop.time()))
+            next_send += interval
+
+            self.sequence += 1
+            name: str = random.choices(names, weights)[0]
+
+            body: dict = self.build(name)
+            body["id"] = self.sequence
+
+            self.pending[self.sequence] = (name, time.perf_counter())
+            await self.ws.send(codec.encode_text(body))
+
+        # Give the last responses a moment to arrive.
+        await asyncio.sleep(1)
+
+        for reader in readers:
+            reader.cancel()
+
+        await self.ws.close()
+        await self.events.close()
+
+
+async def wait_for_server(uri: str):
+    "Wait until the server accepts connections."
+
+    while True:
+        try:
+            ws = await websockets.connect(uri)
+            await ws.close()
+            return
+
+        except OSError:
+            await asyncio.sleep(.1)
+
+
+async def benchmark(options: Options) -> dict:
+    uri = f"ws://{options.host}:{options.port}"
+
+    server = delegateserver.DelegateServer(
+        options.host, options.port, False,
+        db = memorydb.MemoryDatabase()
+    )
+
+    serving = asyncio.create_task(server.main_server())
+    await wait_for_server(uri)
+
+    recorder = Recorder()
+    usernames = [f"bench{number}" for number in range(options.clients)]
+    clients = [BenchClient(number, options, recorder, usernames) for number in range(options.clients)]
+
+    # Signing in is expensive (argon2), so do not do it all at once.
+    slots = asyncio.Semaphore(options.setup_concurrency)
+
+    async def setup(client: BenchClient):
+        async with slots:
+            await client.setup(uri)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[setup(client) for client in clients])
+    print(f"{options.clients} clients signed in after {time.perf_counter() - started:.1f}s")
+
+    # Everyone joins one channel, straight through the server, since there is no join command yet.
+    if ("csend" in options.mix):
+        await channels.ChannelDb(server, bench_channel).register(usernames[0], True)
+        channel = await server.channels.get_channel(bench_channel)
+
+        for username in usernames[1:]:
+            await channel.add_user(username)
+
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+
+    await asyncio.gather(*[client.run(loop.time() + options.duration) for client in clients])
+    elapsed = time.perf_counter() - started
+
+    serving.cancel()
+    return recorder.report(options, elapsed)
+
+
+def parse_mix(mix: str) -> dict:
+    "Parse a mix like usend=50,uget=50"
+
+    result = {}
+
+    for entry in mix.split(","):
+        name, weight = entry.split("=")
+        result[name.strip()] = float(weight)
+
+    return result
+
+
+def main():
+    options = Options()
+
+    try:
+        for i in range(len(sys.argv)):
+            if (sys.argv[i].startswith("-")):
+                if (sys.argv[i] in ["-c", "--clients"]):
+                    options.clients = int(sys.argv[i + 1])
+
+                elif (sys.argv[i] in ["-r", "--rate"]):
+                    options.rate = float(sys.argv[i + 1])
+
+                elif (sys.argv[i] in ["-d", "--duration"]):
+                    options.duration = float(sys.argv[i + 1])
+
+                elif (sys.argv[i] in ["-m", "--mix"]):
+                    options.mix = parse_mix(sys.argv[i + 1])
+
+                elif (sys.argv[i] in ["-p", "--port"]):
+                    options.port = int(sys.argv[i + 1])
+
+                elif (sys.argv[i] in ["-o", "--output"]):
+                    options.output = sys.argv[i + 1]
+
+                else:
+                    eprint(f"Flag '{sys.argv[i]}' not recognized... exiting...")
+                    sys.exit(-1)
+
+    except (IndexError, ValueError):
+        eprint("A flag was given a missing or malformed argument... exiting....")
+        sys.exit(-2)
+
+    report = asyncio.run(benchmark(options))
+    result = codec.encode_text(report)
+
+    print(result)
+
+    # Save it, so that runs can be compared across commits.
+    if (options.output != None):
+        with open(options.output, "w") as f:
+            f.write(result)
+
+
+if (__name__ == "__main__"):
+    main()
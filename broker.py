@@ -0,0 +1,332 @@
+import asyncio
+import os
+
+import codec
+import config
+from util import *
+
+
+# Messages between the broker and the workers are single lines of JSON, each with an "op":
+#   hello   - a worker introduces itself with its worker id
+#   online  - a username gained its first connection on a worker
+#   offline - a username lost its last connection on a worker
+#   event   - an event for a username, delivered to every worker holding them
+#   frame   - an encoded event frame for many usernames, split up per worker holding them
+#   mutate  - a change to the settings of a username, for one worker holding them to apply
+#   written - the settings of a username were written to the database, for every other worker
+#   channel - the state of a channel was written to the database or deleted, for every other worker
+
+class BrokerOps:
+    Hello = "hello"
+    Online = "online"
+    Offline = "offline"
+    Event = "event"
+    Frame = "frame"
+    Mutate = "mutate"
+    Written = "written"
+    Channel = "channel"
+
+
+def encode_message(message: dict) -> bytes:
+    "Encode a broker message into one line."
+
+    return codec.encode(message) + b"\n"
+
+
+class Broker:
+    "Routes events between worker processes over a unix socket."
+
+    def __init__(self, path: str = config.Workers.BrokerPath):
+        self.path: str = path
+
+        # The writer of every connected worker, by worker id.
+        self.workers: dict = {}
+
+        # Which workers hold connections for a username.
+        self.locations: dict = {}
+
+
+    async def listen(self) -> asyncio.AbstractServer:
+        "Bind the broker socket. Workers may connect as soon as this returns."
+
+        # A stale socket from a previous run would prevent binding.
+        if (os.path.exists(self.path)):
+            os.unlink(self.path)
+
+        return await asyncio.start_unix_server(self.handle, path = self.path)
+
+
+    def relay(self, frame: bytes, exclude: int = None):
+        "Send a frame to every worker, except for one."
+
+        for worker, writer in self.workers.items():
+            if (worker != exclude):
+                writer.write(frame)
+
+
+    def set_location(self, username: str, worker: int, online: bool):
+        "Record where a user is connected and tell the other workers."
+
+        holders: set = self.locations.setdefault(username, set())
+
+        if (online):
+            holders.add(worker)
+        else:
+            holders.discard(worker)
+
+        if (holders == set()):
+            del self.locations[username]
+
+        self.relay(encode_message({
+            "op": BrokerOps.Online if online else BrokerOps.Offline,
+            "username": username,
+            "worker": worker
+        }), exclude = worker)
+
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker: int = None
+
+        try:
+            while (line := await reader.readline()):
+                message: dict = codec.decode(line)
+                op: str = message["op"]
+
+                if (op == BrokerOps.Hello):
+                    worker = message["worker"]
+                    self.workers[worker] = writer
+
+                    # Catch the new worker up on who is online elsewhere.
+                    for username, holders in self.locations.items():
+                        for holder in holders:
+                            writer.write(encode_message({
+                                "op": BrokerOps.Online,
+                                "username": username,
+                                "worker": holder
+                            }))
+
+                elif (op == BrokerOps.Online):
+                    self.set_location(message["username"], worker, True)
+
+                elif (op == BrokerOps.Offline):
+                    self.set_location(message["username"], worker, False)
+
+                # Forward the line as is; there is no need to decode the event itself.
+                elif (op == BrokerOps.Event):
+                    for holder in self.locations.get(message["username"], ()):
+                        if (holder != worker):
+                            self.workers[holder].write(line)
+
+                # Each worker only hears about the users it holds.
+                elif (op == BrokerOps.Frame):
+                    targets = {}
+
+                    for username in message["usernames"]:
+                        for holder in self.locations.get(username, ()):
+                            if (holder != worker):
+                                targets.setdefault(holder, []).append(username)
+
+                    for holder, usernames in targets.items():
+                        self.workers[holder].write(encode_message({
+                            "op": BrokerOps.Frame,
+                            "usernames": usernames,
+                            "frame": message["frame"],
+                            "key": message["key"]
+                        }))
+
+                # Addressed to one worker, which may have gone since.
+                elif (op == BrokerOps.Mutate):
+                    if ((target := self.workers.get(message["worker"])) != None):
+                        target.write(line)
+
+                elif (op in (BrokerOps.Written, BrokerOps.Channel)):
+                    self.relay(line, exclude = worker)
+
+                await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError, codec.DecodeError) as error:
+            eprint(f"Broker lost worker {worker}: {error}")
+
+        finally:
+            # Everyone that was connected through this worker is gone.
+            if (worker != None):
+                self.workers.pop(worker, None)
+
+                for username in [u for u, holders in self.locations.items() if worker in holders]:
+                    self.set_location(username, worker, False)
+
+            writer.close()
+
+
+
+class BrokerClient:
+    "The worker side of the broker connection."
+
+    def __init__(self, instance, worker: int, path: str = config.Workers.BrokerPath):
+        self.instance = instance
+        self.worker: int = worker
+        self.path: str = path
+
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.receiver: asyncio.Task = None
+
+        # Usernames that are connected on other workers, mapped to those workers.
+        self.remote: dict = {}
+
+
+    async def connect(self):
+        "Connect to the broker and start receiving routed events."
+
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.send({
+            "op": BrokerOps.Hello,
+            "worker": self.worker
+        })
+
+        self.receiver = asyncio.create_task(self.receive())
+
+
+    def send(self, message: dict):
+        self.writer.write(encode_message(message))
+
+
+    def announce(self, username: str, online: bool):
+        "Tell the other workers that a user came online or went offline on this worker."
+
+        self.send({
+            "op": BrokerOps.Online if online else BrokerOps.Offline,
+            "username": username
+        })
+
+
+    def online_elsewhere(self, username: str) -> bool:
+        "Is the user connected to another worker?"
+
+        return username in self.remote
+
+    def holders(self, username: str) -> list:
+        "The other workers a user is connected to, lowest id first."
+
+        return sorted(self.remote.get(username, ()))
+
+
+    def route(self, username: str, event: str, body: dict):
+        "Deliver an event to the workers holding a user's connections."
+
+        self.send({
+            "op": BrokerOps.Event,
+            "username": username,
+            "event": event,
+            "body": body
+        })
+
+
+    def route_frame(self, usernames: list, frame: str, key: str = None):
+        "Deliver an already encoded event frame to many users on other workers."
+
+        self.send({
+            "op": BrokerOps.Frame,
+            "usernames": usernames,
+            "frame": frame,
+            "key": key
+        })
+
+
+    def mutate(self, worker: int, username: str, change: dict):
+        "Have another worker apply a change to the settings of a user it holds."
+
+        self.send({
+            "op": BrokerOps.Mutate,
+            "worker": worker,
+            "username": username,
+            "change": change
+        })
+
+
+    def written(self, username: str):
+        "Tell the other workers that the settings of a user were written to the database."
+
+        self.send({
+            "op": BrokerOps.Written,
+            "username": username
+        })
+
+
+    def channel_written(self, name: str, settings: list, users: list, removed: list):
+        "Tell the other workers which settings and members of a channel were written to the database."
+
+        self.send({
+            "op": BrokerOps.Channel,
+            "channel": name,
+            "settings": settings,
+            "users": users,
+            "removed": removed,
+            "deleted": False
+        })
+
+    def channel_deleted(self, name: str):
+        self.send({
+            "op": BrokerOps.Channel,
+            "channel": name,
+            "settings": [],
+            "users": [],
+            "removed": [],
+            "deleted": True
+        })
+
+
+    async def receive(self):
+        while (line := await self.reader.readline()):
+            message: dict = codec.decode(line)
+            op: str = message["op"]
+
+            if (op == BrokerOps.Online):
+                if (message["username"] not in self.remote):
+                    self.instance.channels.user_elsewhere(message["username"], True)
+
+                self.remote.setdefault(message["username"], set()).add(message["worker"])
+
+            elif (op == BrokerOps.Offline):
+                holders: set = self.remote.get(message["username"], set())
+                holders.discard(message["worker"])
+
+                if (holders == set() and self.remote.pop(message["username"], None) != None):
+                    self.instance.channels.user_elsewhere(message["username"], False)
+
+            elif (op == BrokerOps.Event):
+                await self.instance.users.send_event(
+                    message["username"],
+                    message["event"],
+                    message["body"],
+                    routed = True
+                )
+
+            elif (op == BrokerOps.Frame):
+                self.instance.users.broadcast_frame(message["usernames"], message["frame"], message["key"])
+
+            # Applied in the order they came, so that one change cannot overtake another.
+            elif (op == BrokerOps.Mutate):
+                try:
+                    await self.instance.users.apply_change(message["username"], message["change"])
+
+                except Exception as error:
+                    eprint(f"Error applying a change to {message['username']}: {error}")
+
+            elif (op == BrokerOps.Written):
+                self.instance.users.forget_settings(message["username"])
+
+            elif (op == BrokerOps.Channel):
+                try:
+                    await self.instance.channels.channel_written(
+                        message["channel"],
+                        message["settings"],
+                        message["users"],
+                        message["removed"],
+                        message["deleted"]
+                    )
+
+                except Exception as error:
+                    eprint(f"Error reloading channel {message['channel']}: {error}")
+
+        eprint(f"Worker {self.worker} lost its connection to the broker.")
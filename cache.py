@@ -0,0 +1,70 @@
+import collections
+import time
+
+import metrics
+
+
+class LRUCache:
+    def __init__(self, name: str, size: int, ttl: float):
+        """A dictionary that holds at most size entries, each for at most ttl seconds.
+        Once full, the least recently used entry is evicted to make room.
+        name labels its hit, miss and eviction counters.
+        """
+
+        self.name: str = name
+        self.size: int = size
+        self.ttl: float = ttl
+
+        # key -> (time it expires, value), least recently used first.
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        entry = self.entries.get(key)
+        return entry != None and entry[0] > time.monotonic()
+
+
+    def get(self, key, default = None):
+        "The cached value, or default if it is missing or has expired."
+
+        entry = self.entries.get(key)
+
+        if (entry == None):
+            metrics.cache_misses.inc(value = self.name)
+            return default
+
+        if (entry[0] <= time.monotonic()):
+            del self.entries[key]
+            metrics.cache_misses.inc(value = self.name)
+            return default
+
+        self.entries.move_to_end(key)
+        metrics.cache_hits.inc(value = self.name)
+        return entry[1]
+
+
+    def put(self, key, value):
+        "Cache a value, evicting the least recently used entry if there is no room."
+
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+            metrics.cache_evictions.inc(value = self.name)
+
+
+    def update(self, key, value):
+        "Replace a value, but only if it is already cached."
+
+        if (key in self.entries):
+            self.put(key, value)
+
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
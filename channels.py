@@ -1,15 +1,19 @@
-import json
+import asyncio
+import codec
 import time
-import psycopg2
 import users
+import database
+import expiry
+import metrics
+import writebehind
 
 
 from definitions import *
 from util import *
 from config import *
 
-CHANNEL_BAN_FOREVER = 0
-CHANNEL_MUTE_FOREVER = 0
+CHANNEL_BAN_FOREVER = FOREVER
+CHANNEL_MUTE_FOREVER = FOREVER
 
 
 def generate_user_field(role = "default") -> dict:
@@ -131,10 +135,41 @@ class ChannelPermissions:
     Admin = "admin"
 
 
+# Every permission as one bit, so that the permissions of a role are a single integer.
+permission_bits: dict = {
+    permission: 1 << bit for bit, permission in enumerate([
+        ChannelPermissions.Talk, ChannelPermissions.Read, ChannelPermissions.Remove,
+        ChannelPermissions.Subchannel, ChannelPermissions.Metadata, ChannelPermissions.Set,
+        ChannelPermissions.Kick, ChannelPermissions.Ban, ChannelPermissions.Mute,
+        ChannelPermissions.Role, ChannelPermissions.Invite, ChannelPermissions.Password,
+        ChannelPermissions.Order, ChannelPermissions.Vote, ChannelPermissions.Cast,
+        ChannelPermissions.Summon, ChannelPermissions.Admin
+    ])
+}
+
+ALL_PERMISSIONS: int = sum(permission_bits.values())
+
+
+def permission_mask(role: list) -> int:
+    """The permissions of a role entry as a bitmask. Its first element is the list of permissions,
+    or None for every permission. Permissions this server does not know are ignored.
+    """
+
+    if (role == [] or role[0] == None):
+        return ALL_PERMISSIONS if role != [] else 0
+
+    mask: int = 0
+
+    for permission in role[0]:
+        mask |= permission_bits.get(permission, 0)
+
+    return mask
+
+
 class Channel:
     "A Delegate channel"
 
-    def __init__(self, instance, name, state: dict, channels, users):
+    def __init__(self, instance, name, state: dict, channels):
         # The reference to the DelegateServer class instance
         self.instance = instance
 
@@ -144,7 +179,6 @@ class Channel:
         # Run of the mill initializations.
         self.name = name
         self.channels = channels
-        self.usersinst = users
 
         # Information about the channel not under the channel settings, as specified by the
         # protocol.
@@ -154,6 +188,42 @@ class Channel:
         # This stays private to the outside. Not accessible via settings.
         self.users = self.auxiliary["users"]
 
+        self.settings = state["settings"]
+        self.bind_settings()
+
+        self.cdb: ChannelDb = ChannelDb(instance, name)
+
+        # The roles compiled into bitmasks, by role and by subchannel then role, and the order into ranks.
+        self.masks: dict = {}
+        self.subchannel_masks: dict = {}
+        self.ranks: dict = {}
+        self.compile_roles()
+
+        # Members listening for events on this worker, for the whole channel and by subchannel,
+        # so that broadcasts only ever look at who will receive them.
+        self.online: set = set()
+        self.subchannel_online: dict = {}
+
+        # Members connected to other workers, kept up to date from the broker.
+        self.remote: set = set()
+
+        self.index_online()
+        channels.track_members(self)
+
+        # Bans and mutes are lifted by the server-wide scheduler once they run out.
+        channels.expiry.watch(self)
+
+        # What changed since the channel was last written: settings by key, and members by username.
+        self.changed: set = set()
+        self.changed_users: set = set()
+        self.removed_users: set = set()
+
+        # When it was last asked for, so that it can be unloaded once nobody uses it.
+        self.last_used: float = time.time()
+
+
+    def bind_settings(self):
+        "Point the shorthands at the settings. Must be called whenever a setting is replaced."
 
         # All of the useful channel settings that are
         # publicly accessible through the public setting
@@ -167,9 +237,142 @@ class Channel:
         
         self.subchannels = self.settings["$subchannels"]
 
-        self.settings = state["settings"]
 
-        self.cdb: ChannelDb = ChannelDb(instance, name)
+    def refresh(self, state: dict, settings: list, users: list, removed: list):
+        """Take the settings and members that another worker wrote from freshly read state.
+        Whatever changed here and is still waiting to be written is kept, as it will be written over them.
+        """
+
+        # The bans and mutes are scheduled again from the new records.
+        self.channels.expiry.unwatch(self)
+
+        for key in settings:
+            if (key not in self.changed):
+                self.settings[key] = state["settings"][key]
+
+        self.bind_settings()
+        self.compile_roles()
+
+        members: dict = state["auxiliary"]["users"]
+
+        for username in users:
+            if (username in self.changed_users or username in self.removed_users or username not in members):
+                continue
+
+            self.users[username] = members[username]
+            self.channels.memberships.setdefault(username, set()).add(self.name)
+
+        for username in removed:
+            if (username in self.changed_users or username not in self.users):
+                continue
+
+            del self.users[username]
+            self.channels.untrack(username, self.name)
+
+        # Roles, subchannels and members may all have changed, so the indexes are built again.
+        self.index_online()
+        self.channels.expiry.watch(self)
+
+
+    def compile_roles(self):
+        "Compile the roles and their order. Must be called whenever either, or the roles of a subchannel, change."
+
+        self.ranks = {role: rank for rank, role in enumerate(self.order)}
+        self.masks = {role: permission_mask(entry) for role, entry in self.roles.items()}
+
+        self.subchannel_masks = {
+            name: {role: permission_mask(entry) for role, entry in subchannel["$roles"].items()}
+            for name, subchannel in self.subchannels.items()
+        }
+
+
+    def can_see(self, username: str, subchannel: str) -> bool:
+        "Can a member see a subchannel, and so receive its events?"
+
+        state: dict = self.subchannels[subchannel]
+
+        if (not state["private"]):
+            return True
+
+        role: str = self.get_role(username)
+        return role == "owner" or username in state["allowed_users"] or role in state["allowed_roles"]
+
+    def listening(self, username: str) -> bool:
+        "Is a member signed in on this worker with an event connection?"
+
+        return (user := self.usersinst.users.get(username)) != None and user.event_connections != {}
+
+    def index_online(self):
+        "Build the online indexes from scratch."
+
+        self.online = {username for username in self.users if self.listening(username)}
+
+        broker = self.instance.broker
+        self.remote = set() if broker == None else {username for username in self.users if broker.online_elsewhere(username)}
+
+        for name in self.subchannels:
+            self.index_subchannel(name)
+
+    def index_subchannel(self, name: str):
+        "Build the online index of one subchannel from that of the channel."
+
+        self.subchannel_online[name] = {username for username in self.online if self.can_see(username, name)}
+
+    def index_member(self, username: str):
+        "A member started listening for events, or joined while listening."
+
+        self.online.add(username)
+
+        for name, online in self.subchannel_online.items():
+            if (self.can_see(username, name)):
+                online.add(username)
+
+    def unindex_member(self, username: str):
+        "A member stopped listening for events, or left."
+
+        self.online.discard(username)
+
+        for online in self.subchannel_online.values():
+            online.discard(username)
+
+    def recipients(self, online: set, subchannel: str = None, user: str = None):
+        """Who an event sent to an online index reaches, including members connected to other workers
+        who may receive it: only the user given, or only those who can see the subchannel given.
+        """
+
+        if (self.remote == set()):
+            return online
+
+        if (user != None):
+            remote = self.remote & {user}
+
+        elif (subchannel != None):
+            remote = {username for username in self.remote if self.can_see(username, subchannel)}
+
+        else:
+            remote = self.remote
+
+        return online | remote
+
+
+    def mark(self, *settings: str):
+        "Queue the settings named to be written to the database."
+
+        self.changed.update(settings)
+        self.channels.writer.mark(self.name, self)
+
+    def mark_user(self, username: str, removed: bool = False):
+        "Queue a member to be written to the database, or to be removed from it."
+
+        if (removed):
+            self.changed_users.discard(username)
+            self.removed_users.add(username)
+
+        else:
+            self.removed_users.discard(username)
+            self.changed_users.add(username)
+
+        self.channels.writer.mark(self.name, self)
         
 
     def form_event(self, event, channel, body) -> dict:
@@ -181,8 +384,8 @@ class Channel:
         return result
 
 
-    async def broadcast_event(self, event: str, body: dict, subchannel: str = None, user: str = None):
-        "Send an event to people/a person."
+    async def broadcast_event(self, event: str, body: dict, subchannel: str = None, user: str = None) -> int:
+        "Send an event to people/a person. Returns how many sockets it was sent to."
         
         # Automatically add the channel as a field in the body of the event.
         body.update({"channel": self.name})
@@ -190,22 +393,22 @@ class Channel:
         # Sending it to members of a subchannel only.
         if (subchannel != None):
             body.update({"subchannel": subchannel})
-            return
+            return await self.usersinst.broadcast_event(
+                self.recipients(self.subchannel_online[subchannel], subchannel = subchannel), event, body
+            )
 
         # Sending it to ONE user.
         if (user != None):
-            pass
-            return
+            return await self.usersinst.broadcast_event(self.recipients({user} & self.online, user = user), event, body)
 
-        # Send it to every user in every channel.
-        for usr in self.userlist:
-            await self.usersinst.send_event(usr, event, body)
+        # Send it to every user in every channel, encoding the event only once.
+        return await self.usersinst.broadcast_event(self.recipients(self.online), event, body)
 
 
     async def user_event(self, username: str, event: str, body: dict):
         "Issue an (abstract) event to a username."
 
-        await self.userlist.send_event(username, event, body)
+        await self.usersinst.send_event(username, event, body)
 
     async def ban_user(self, by: str, username: str, reason: str, duration: int):
         # Add them to the ban list.
@@ -215,6 +418,9 @@ class Channel:
             "when": round(time.time())
         }
 
+        self.mark("$banned")
+        self.channels.expiry.schedule_record(self.name, expiry.Ban, username, self.banned[username])
+
         # Issue an event to that user, signifying that they were banned.
         await self.usersinst.send_event(username, "banned", {
             "channel": self.name,
@@ -223,8 +429,55 @@ class Channel:
             "reason": reason
         })
 
-        # Remove them from the server and alert 
-        await self.remove_user(username, circumstance = "banned")
+        # Remove them from the server and alert, if they were even in it
+        if (username in self.users):
+            await self.remove_user(username, circumstance = "banned")
+
+    async def unban_user(self, username: str, by: str = None):
+        "Lift a ban. It was lifted by the server when by is None: it ran out."
+
+        if (self.banned.pop(username, None) == None):
+            return
+
+        self.mark("$banned")
+        self.channels.expiry.forget((self.name, expiry.Ban, username))
+
+        # They are no longer a member, so only they hear about it.
+        await self.user_event(username, "unbanned", {
+            "channel": self.name,
+            "username": by
+        })
+
+    async def mute_user(self, by: str, username: str, reason: str, duration: int):
+        self.muted[username] = {
+            "duration": duration,
+            "reason": reason,
+            "when": round(time.time())
+        }
+
+        self.mark("$muted")
+        self.channels.expiry.schedule_record(self.name, expiry.Mute, username, self.muted[username])
+
+        await self.broadcast_event("muted", {
+            "username": username,
+            "by": by,
+            "duration": duration,
+            "reason": reason
+        })
+
+    async def unmute_user(self, username: str, by: str = None):
+        "Lift a mute. It was lifted by the server when by is None: it ran out."
+
+        if (self.muted.pop(username, None) == None):
+            return
+
+        self.mark("$muted")
+        self.channels.expiry.forget((self.name, expiry.Mute, username))
+
+        await self.broadcast_event("unmuted", {
+            "username": username,
+            "by": by
+        })
 
     async def kick_user(self, by: str, username: str, reason: str):
         # Send the user the event that they have been kicked.
@@ -248,22 +501,41 @@ class Channel:
         duration: int = self.banned[username]["duration"]
         when: int = self.banned[username]["when"]
 
-        # They are still banned, so return true.
-        if (duration == CHANNEL_BAN_FOREVER or not (round(time.time()) > (duration + when))):
-            return True
+        # Their ban may have run out a moment before the scheduler gets to lifting it.
+        return duration == CHANNEL_BAN_FOREVER or not (round(time.time()) > (duration + when))
+
+    def is_muted(self, username: str) -> bool:
+        "Is the user muted--unable to talk?"
+
+        if (username not in self.muted):
+            return False
+
+        duration: int = self.muted[username]["duration"]
+        when: int = self.muted[username]["when"]
+
+        # Their mute may have run out a moment before the scheduler gets to lifting it.
+        return duration == CHANNEL_MUTE_FOREVER or not (round(time.time()) > (duration + when))
 
+    def count_sent(self, username: str):
+        "Count a message a member sent."
 
-        # Their ban expired, so delete their entry and return that they are no longer banned.
-        del self.banned[username]
-        return False
+        self.users[username]["settings"]["$sent"] += 1
+        self.mark_user(username)
 
     async def delete_channel(self):
         "Delete the channel. Permanently."
 
-        self.cdb.delete()
-        await self.broadcast_event("cdeleted")
+        # Whatever was still waiting to be written is moot now.
+        self.channels.writer.dirty.pop(self.name, None)
+
+        await self.cdb.delete()
+        await self.broadcast_event("cdeleted", {})
         self.channels.unload_channel(self.name)
 
+        # Other workers may have it loaded as well.
+        if (self.instance.broker != None):
+            self.instance.broker.channel_deleted(self.name)
+
 
 
 
@@ -274,6 +546,10 @@ class Channel:
         "Add a subchannel to the channel."
 
         self.subchannels[name] = generate_subchannel_state()
+        self.compile_roles()
+        self.index_subchannel(name)
+        self.mark("$subchannels")
+
         await self.broadcast_event("subchannel", {
             "subchannel": name,
             "status": "created"
@@ -283,6 +559,21 @@ class Channel:
         "Remove a user from the channel."
 
         del self.users[username]
+
+        if (username in self.userlist):
+            self.userlist.remove(username)
+
+        self.settings["$userno"] = self.userno = len(self.users)
+
+        self.mark("$userlist", "$userno")
+        self.mark_user(username, removed = True)
+
+        self.unindex_member(username)
+        self.remote.discard(username)
+        self.channels.untrack(username, self.name)
+
+        await self.usersinst.append_user_settings(username, "!channels", [self.name], remove = True)
+
         await self.broadcast_event("leave", {
             "username": username,
             "message": message,
@@ -293,6 +584,10 @@ class Channel:
         "Duplicate an existing subchannel to a new one."
 
         self.subchannels[new] = self.subchannels[old].copy()
+        self.compile_roles()
+        self.index_subchannel(new)
+        self.mark("$subchannels")
+
         await self.broadcast_event("subchannel", {
             "subchannel": new,
             "status": "created"
@@ -301,7 +596,26 @@ class Channel:
     async def add_user(self, username: str, message: str = None, role = "default"):
         "Add a user to the channel, giving them data."
 
-        self.users[username] = generate_user_field(username, role = role)
+        self.users[username] = generate_user_field(role = role)
+
+        if (username not in self.userlist):
+            self.userlist.append(username)
+
+        self.settings["$userno"] = self.userno = len(self.users)
+
+        self.mark("$userlist", "$userno")
+        self.mark_user(username)
+
+        if (self.listening(username)):
+            self.index_member(username)
+
+        if (self.instance.broker != None and self.instance.broker.online_elsewhere(username)):
+            self.remote.add(username)
+
+        self.channels.memberships.setdefault(username, set()).add(self.name)
+
+        await self.usersinst.append_user_settings(username, "!channels", [self.name])
+
         await self.broadcast_event("join", {
             "username": username,
             "message": message
@@ -325,7 +639,7 @@ class Channel:
             raise KeyError("One role is missing from the role_order")
 
         role: str = self.get_role(username)
-        index: int = self.order.index(role)
+        index: int = self.ranks[role]
 
         # Find the value and indices of roles that are at or below (more powerful)
         # the current role of the user.
@@ -343,7 +657,9 @@ class Channel:
 
 
         # It was a success: the role order has been changed.
-        self.order = role_order
+        self.order = self.settings["$order"] = role_order
+        self.compile_roles()
+        self.mark("$order")
 
 
     def get_role(self, username) -> str:
@@ -354,35 +670,26 @@ class Channel:
     def has_permission(self, username: str, perm: str, subchannel: str = None) -> bool:
         "Return whether a user has permission to do something or not."
 
+        role: str = self.get_role(username)
+
         # Owner always has every permission
-        if (self.get_role(username) == "owner"):
+        if (role == "owner"):
             return True
 
-        # Get user channel-wide permissions.
-        perms = self.perms(username)
+        # Channel-wide permissions, along with those the subchannel gives the role, if one is given.
+        mask: int = self.masks.get(role, 0)
 
-        # You can laugh, but I am not changing the name of this variable.
-        sperms = [] 
-        
-        # Get subchannel permissions if a subchannel is given to us.
         if (subchannel != None):
-            sperms = self.subchannels[subchannel]["roles"][self.get_role(username)]
+            mask |= self.subchannel_masks.get(subchannel, {}).get(role, 0)
 
         # "admin" permissions always has every permission, except for channel deletion.
-        if (ChannelPermissions.Admin in perms or ChannelPermissions.Admin in sperms):
-            return True
-
-
-        return (perm in perms) or (perm in sperms)
+        return mask & (permission_bits[perm] | permission_bits[ChannelPermissions.Admin]) != 0
 
 
     def can_moderate(self, username1, username2) -> bool:
         "Can username1 moderate username2?"
 
-        order1 = self.order.index(self.get_role(username1))
-        order2 = self.order.index(self.get_role(username2))
-
-        return order1 < order2
+        return self.ranks[self.get_role(username1)] < self.ranks[self.get_role(username2)]
 
     def perms(self, username) -> list:
         "Return all permissions that a given user has."
@@ -392,44 +699,226 @@ class Channel:
 
         
 
+class ChannelStateWriter(writebehind.WriteBehind):
+    def __init__(self, instance, interval: float = ChannelStateWrites.Interval, batch_size: int = ChannelStateWrites.BatchSize):
+        """Writes the state of changed channels to the database, by channel name.
+        Only the settings and members that changed are sent, and each batch is one transaction.
+        """
+
+        super().__init__("channel", interval, batch_size, metrics.channeldb_flush_seconds, metrics.channeldb_flush_size)
+
+        self.instance = instance
+        metrics.channeldb_queue_depth.track(lambda: len(self.dirty))
+
+
+    async def write(self, batch: list):
+        # Encoded now, so that the latest values are what gets written.
+        changed: list = []
+        settings: list = []
+        members: list = []
+        removals: list = []
+
+        for channel in batch:
+            changed.append((channel.changed, channel.changed_users, channel.removed_users))
+
+            settings.append(codec.encode_text({key: channel.settings[key] for key in channel.changed}))
+            members.append(codec.encode_text({username: channel.users[username] for username in channel.changed_users}))
+            removals.extend((username, channel.name) for username in channel.removed_users)
+
+            channel.changed = set()
+            channel.changed_users = set()
+            channel.removed_users = set()
+
+        try:
+            await ChannelDb.write_many(self.instance, [channel.name for channel in batch], settings, members, removals)
+
+        except Exception:
+            # Along with whatever changed in the meantime, unless a member was since added or removed again.
+            for channel, (keys, changed_users, removed_users) in zip(batch, changed):
+                channel.changed.update(keys)
+                channel.changed_users.update(changed_users - channel.removed_users)
+                channel.removed_users.update(removed_users - channel.changed_users)
+
+            raise
+
+        # Other workers that have these channels loaded read what was written.
+        if ((broker := self.instance.broker) != None):
+            for channel, (keys, changed_users, removed_users) in zip(batch, changed):
+                broker.channel_written(channel.name, list(keys), list(changed_users), list(removed_users))
+
+
+
 class Channels:
     def __init__(self, instance):
         self.channels = {}
         self.instance = instance
 
-        self.database = self.instance.database
-        self.cursor = self.instance.cursor
+        self.database: database.Database = self.instance.db
+
+        # Changed channels are written to the database in batches.
+        self.writer: ChannelStateWriter = ChannelStateWriter(instance)
+
+        # The loaded channels of every member of one, so that news of a user goes straight to their channels.
+        self.memberships: dict = {}
+
+        # Lifts the bans and mutes of loaded channels once they run out.
+        self.expiry: expiry.ExpiryScheduler = expiry.ExpiryScheduler(self)
+        self.evictor_t: asyncio.Task = None
+
+        metrics.loaded_channels.track(lambda: len(self.channels))
+
+
+    def start(self):
+        "Start the background tasks. Must be called from within the running event loop."
+
+        self.writer.start()
+        self.expiry.start()
+        self.evictor_t = asyncio.create_task(self.evict_idle())
+
+
+    async def stop(self):
+        "Write out all changed channel state. Called on shutdown."
+
+        if (self.evictor_t != None):
+            self.evictor_t.cancel()
+            self.evictor_t = None
+
+        self.expiry.stop()
+        await self.writer.stop()
 
     
     def unload_channel(self, channel: str):
         "Unload a channel object from memory by its string name."
 
-        del self.channels[channel]
+        # If it has unwritten changes, the writer still holds on to it until they are written.
+        unloaded: Channel = self.channels.pop(channel)
+
+        self.expiry.unwatch(unloaded)
+        self.untrack_members(unloaded)
+
+
+    def track_members(self, channel: Channel):
+        "Index the members of a channel that was just loaded."
+
+        for username in channel.users:
+            self.memberships.setdefault(username, set()).add(channel.name)
+
+    def untrack_members(self, channel: Channel):
+        for username in channel.users:
+            self.untrack(username, channel.name)
+
+    def untrack(self, username: str, channel: str):
+        "A member left a loaded channel, or it was unloaded."
+
+        if ((names := self.memberships.get(username)) != None):
+            names.discard(channel)
+
+            if (names == set()):
+                del self.memberships[username]
+
+
+    def has_online_members(self, channel: Channel) -> bool:
+        "Is any member listening on this worker or connected to another? Read from the online indexes."
+
+        return channel.online != set() or channel.remote != set()
+
+
+    def user_listening(self, username: str, channels: list):
+        "A user started listening for events: add them to the online index of their loaded channels."
+
+        for name in channels:
+            if ((channel := self.channels.get(name)) != None and username in channel.users):
+                channel.index_member(username)
+
+    def user_not_listening(self, username: str, channels: list):
+        "A user stopped listening for events."
+
+        for name in channels:
+            if ((channel := self.channels.get(name)) != None):
+                channel.unindex_member(username)
+
+    def user_elsewhere(self, username: str, online: bool):
+        "A user came online on another worker, or went offline on all of them. Told by the broker."
+
+        for name in self.memberships.get(username, ()):
+            if (online):
+                self.channels[name].remote.add(username)
+            else:
+                self.channels[name].remote.discard(username)
 
 
+    async def channel_written(self, name: str, settings: list, users: list, removed: list, deleted: bool):
+        "Another worker wrote the state of a channel, or deleted it. Told by the broker."
 
-    def add_channel(self, channel: str):
+        if ((channel := self.channels.get(name)) == None):
+            return
+
+        if (deleted):
+            self.writer.dirty.pop(name, None)
+            self.unload_channel(name)
+            return
+
+        state: dict = await ChannelDb(self.instance, name).getstate()
+
+        # Unloaded, or loaded again, while the state was being read.
+        if (self.channels.get(name) is channel):
+            channel.refresh(state, settings, users, removed)
+
+
+    async def evict_idle(self):
+        "Unload channels that nobody has asked for in a while and that have no online members."
+
+        while True:
+            await asyncio.sleep(ChannelEviction.Interval)
+
+            cutoff: float = time.time() - ChannelEviction.IdleTime
+
+            for name, channel in list(self.channels.items()):
+                if (channel.last_used < cutoff and not self.has_online_members(channel)):
+                    self.unload_channel(name)
+                    metrics.channels_evicted.inc()
+
+
+
+    async def add_channel(self, channel: str):
         "Add a channel from the database into memory."
 
+        # It was unloaded, but its last changes are still waiting to be written or being written,
+        # so they are the newest state.
+        if ((pending := self.writer.held(channel)) != None):
+            # Nobody kept its online index up to date while it was unloaded, nor watched its bans.
+            pending.index_online()
+            self.expiry.watch(pending)
+            self.track_members(pending)
+            self.channels[channel] = pending
+            return
+
         cdb = ChannelDb(self.instance, channel)
-        self.channels[channel] = Channel(channel, cdb.getstate())
+        state: dict = await cdb.getstate()
+
+        # Someone else loaded it while the state was being read.
+        if (channel not in self.channels):
+            self.channels[channel] = Channel(self.instance, channel, state, self)
 
-    def get_channel(self, channel: str) -> Channel:
+    async def get_channel(self, channel: str) -> Channel:
         "Get a channel--if it isn't loaded into memory, do so."
 
         if (channel not in self.channels):
-            self.add_channel(channel)
+            await self.add_channel(channel)
+
+        result: Channel = self.channels[channel]
+        result.last_used = time.time()
 
-        return self.channels[channel]
+        return result
 
-    def channel_exists(self, channel: str) -> bool:
+    async def channel_exists(self, channel: str) -> bool:
         "Efficient way to determine whether the given channel exists or not"
 
         if (channel in self.channels):
             return True
 
         cdb = ChannelDb(self.instance, channel)
-        return cdb.exists()
+        return await cdb.exists()
 
 
 
@@ -439,57 +928,86 @@ class ChannelDb:
     def __init__(self, instance, name):
         self.name = name
         self.instance = instance
-        self.database: psycopg2.cursor = instance.cursor
+        self.database: database.Database = instance.db
 
-    def exists(self) -> bool:
+    @metrics.timed(metrics.sql_seconds)
+    async def exists(self) -> bool:
         "Returns whether the channel is registered or not [MUST BE, ACCORDING TO PROTOCOL]"
 
-        self.database.execute("SELECT channel FROM Channels WHERE channel = %s;", (self.name,))
-        return self.database.fetchone() != None
+        row = await self.database.fetchone("SELECT channel FROM Channels WHERE channel = %s;", (self.name,))
+        return row != None
 
-    def getstate(self) -> dict:
+    @metrics.timed(metrics.sql_seconds)
+    async def getstate(self) -> dict:
         "Get the state of the channel and return it as a dictionary object."
 
-        self.database.execute("SELECT state FROM Channels WHERE channel = %s;", (self.name,))
-        return json.loads(self.database.fetchone()[0])
+        # As text, so that the codec decodes it rather than psycopg2.
+        row = await self.database.fetchone("SELECT state::text FROM Channels WHERE channel = %s;", (self.name,))
+        return codec.decode(row[0])
 
 
-    def delete(self):
+    @metrics.timed(metrics.sql_seconds)
+    async def delete(self):
         "Delete the channel from the database"
 
-        self.database.execute("DELETE FROM Channels WHERE channel = %s;", (self.name,))
-        self.instance.database.commit()
+        await self.database.execute("DELETE FROM Channels WHERE channel = %s;", (self.name,))
 
-    def register(self, username: str, group: bool):
-        "Register a channel"
+    @metrics.timed(metrics.sql_seconds)
+    async def register(self, username: str, group: bool) -> bool:
+        "Register a channel, returning False if one by that name was registered first"
 
         created = round(time.time())
 
-        self.database.execute("INSERT INTO Channels (channel, created, state) VALUES (%s, %s, %s);", (
+        # The primary key settles two registrations racing for the same name.
+        row = await self.database.fetchone((
+            "INSERT INTO Channels (channel, created, state) VALUES (%s, %s, %s) "
+            "ON CONFLICT DO NOTHING RETURNING channel;"
+        ), (
             self.name,
             created,
-            generate_default_channel_state(generate_channel_settings(created, username, group))
+            codec.encode_text(generate_default_channel_state(generate_channel_settings(created, username, group), username))
         ))
 
-        self.instance.database.commit()
+        return row != None
 
-    def setstate(self, settings):
+    @metrics.timed(metrics.sql_seconds)
+    async def setstate(self, settings):
         "Set the state of the channel"
 
-        self.database.execute("UPDATE Channels SET state = %s WHERE channel = %s;", (
-            json.dumps(settings),
+        await self.database.execute("UPDATE Channels SET state = %s WHERE channel = %s;", (
+            codec.encode_text(settings),
             self.name
         ))
 
-        self.instance.database.commit()
+    @staticmethod
+    @metrics.timed(metrics.sql_seconds)
+    async def write_many(instance, names: list, settings: list, members: list, removals: list):
+        """Write the changes of many channels in one transaction.
+        settings and members are encoded objects of what changed, one for each name,
+        which are merged into the stored ones. removals are (username, channel) of members who left.
+        """
 
-    def gettime(self) -> int:
+        def write(cursor):
+            for removal in removals:
+                cursor.execute(
+                    "UPDATE Channels SET state = state #- ARRAY['auxiliary', 'users', %s] WHERE channel = %s;", removal
+                )
+
+            cursor.execute(
+                "UPDATE Channels SET state = jsonb_set(jsonb_set(state, "
+                "'{settings}', (state->'settings') || batch.settings::jsonb), "
+                "'{auxiliary,users}', (state->'auxiliary'->'users') || batch.members::jsonb) "
+                "FROM (SELECT UNNEST(%s::text[]) AS channel, UNNEST(%s::text[]) AS settings, "
+                "UNNEST(%s::text[]) AS members) AS batch "
+                "WHERE Channels.channel = batch.channel;",
+                (names, settings, members)
+            )
+
+        await instance.db.run(write)
+
+    @metrics.timed(metrics.sql_seconds)
+    async def gettime(self) -> int:
         "Get the creation time of the channel."
 
-        self.database.execute("SELECT created FROM Channels WHERE channel = %s;", (self.name,))
-        return int(self.database.fetchone()[0])
-
-
-    
-
-
+        row = await self.database.fetchone("SELECT created FROM Channels WHERE channel = %s;", (self.name,))
+        return int(row[0])
@@ -0,0 +1,83 @@
+import json
+
+import config
+
+from orderedset import OrderedSet
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+
+# orjson.JSONDecodeError is a subclass of this, so it catches either codec's errors.
+DecodeError = json.JSONDecodeError
+
+
+def _default(value):
+    "Encode types that JSON does not know about."
+
+    # Relationship collections are stored and sent as plain lists.
+    if (isinstance(value, OrderedSet)):
+        return list(value)
+
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class StdlibCodec:
+    "The json module from the standard library. Always available."
+
+    name = "json"
+
+    @staticmethod
+    def encode(value) -> bytes:
+        return json.dumps(value, separators = (",", ":"), default = _default).encode()
+
+    @staticmethod
+    def encode_text(value) -> str:
+        return json.dumps(value, separators = (",", ":"), default = _default)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    "orjson, which encodes straight to bytes. Only available if it is installed."
+
+    name = "orjson"
+
+    @staticmethod
+    def encode(value) -> bytes:
+        return orjson.dumps(value, default = _default)
+
+    @staticmethod
+    def encode_text(value) -> str:
+        return orjson.dumps(value, default = _default).decode()
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+# Every codec that can be used here, by name.
+codecs = {
+    StdlibCodec.name: StdlibCodec
+}
+
+if (orjson != None):
+    codecs[OrjsonCodec.name] = OrjsonCodec
+
+
+# The codec the whole server uses, falling back on the standard library.
+active = codecs.get(config.Serialization.Codec, StdlibCodec)
+
+# bytes, for sockets and pipes that take bytes.
+encode = active.encode
+
+# str, for websocket text frames and TEXT columns.
+encode_text = active.encode_text
+
+# Takes either str or bytes.
+decode = active.decode
@@ -1,24 +1,20 @@
-import json
+import codec
 
 import users
 import channels
 import config
 import messages
+import schemas
+import metrics
+import hashing
+import tokens
 
+from schemas import Field
 from settings import *
 from util import *
 from definitions import *
 
 
-def type_test(variables: list, types: list):
-    "Given a list of variables, then a list of their supposed types, check if its true."
-
-    for i in range(len(variables)):
-        if (not isinstance(variables[i], types[i])):
-            return False
-
-    return True
-
 class DelegateCommand:
     def __init__(self, connection, instance, command, body, user):
         self.connection = connection
@@ -28,83 +24,130 @@ class DelegateCommand:
 
         self.command: str = command
         self.body: dict = body
+
+        # Tagged commands may run concurrently; their responses carry the tag back.
+        self.id = body.get("id")
+
+        # Whether a response code has been sent for this command.
+        self.responded: bool = False
         self.user: users.User = user
         self.users: users.Users = instance.users
         self.channels: channels.Channels = instance.channels
 
     @staticmethod
     def from_json(connection, instance, ccode, user):
-        "Loads a command from raw JSON data."
+        "Loads a command from raw JSON data. Returns None if it is not a JSON object."
         
-        code = json.loads(ccode)
-        return DelegateCommand(connection, instance, code["command"], code, user)
+        code = codec.decode(ccode)
 
+        if (not isinstance(code, dict)):
+            return None
 
-async def authenticate_command(command: DelegateCommand) -> bool:
-    try:
-        password: str = command.body["password"]
+        return DelegateCommand(connection, instance, code.get("command"), code, user)
 
-        # Gotta type test.
-        if (not isinstance(password, str)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
+    async def code(self, code: int, body: dict = {}):
+        "Issue a response code for this command, tagged with its id if it has one."
 
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+        if (self.id != None):
+            body = {**body, "id": self.id}
 
-    
-    return (password == config.ServerPassword.Password)
+        self.responded = True
+        await self.connection.code(code, body)
 
+    def validate(self) -> int:
+        "Check the body against the command's schema. Returns the error code, or None if it is valid."
 
+        # Anything but a name (or nothing at all) cannot even be looked up.
+        if (type(self.command) not in [str, NoneType]):
+            return CommandCodes.InvalidTypes
 
-async def initial_user_signin(command: DelegateCommand) -> bool:
-    try:
-        username: str = command.body["username"]
-        password: str = command.body["password"]
-        event: bool = command.body["event"]
-        tfa: str = None if "2fa" not in command.body else command.body["2fa"]
+        if ((validator := validators.get(self.command)) == None):
+            return None
 
-        # Validate the types that are sent in by the client.
-        if (not type_test([username, password, event], [str, str, bool]) or 
-            (tfa != None and not isinstance(tfa, str))):
+        return validator(self.body)
 
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
 
-    
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return False
+async def authenticate_command(command: DelegateCommand) -> bool:
+    return (command.body["password"] == config.ServerPassword.Password)
 
 
 
+async def password_signin(command: DelegateCommand, username: str, password: str, tfa: str) -> bool:
     udb = users.UserDb(command.instance, username)
 
     # If the user is not registered.
-    if (not udb.exists()):
-        await command.connection.code(UserCodes.Errors.UsernameNoent)
+    if (not await udb.exists()):
+        await command.code(UserCodes.Errors.UsernameNoent)
+        return False
+
+    # Too many sign-ins are already waiting on password verification.
+    try:
+        verified: bool = await udb.verify(password)
+
+    except hashing.Saturated:
+        await command.code(ServerCodes.Error.Busy)
         return False
 
     # Incorrect password
-    if (not udb.verify(password)):
-        await command.connection.code(UserCodes.Errors.PasswordIncorrect)
+    if (not verified):
+        await command.code(UserCodes.Errors.PasswordIncorrect)
         return False
 
 
     # If two-factor authentication is required and it is denied, error.
-    if (command.users.has_2fa(username)):
-        if (tfa == None or not command.users.verify_2fa(username, tfa)):
-            await command.connection.code(UserCodes.Errors.TwoFactorVerify)
+    if (await command.users.has_2fa(username)):
+        if (tfa == None or not await command.users.verify_2fa(username, tfa)):
+            await command.code(UserCodes.Errors.TwoFactorVerify)
+            return False
+
+    return True
+
+
+async def token_signin(command: DelegateCommand, username: str, token: str) -> bool:
+    claims: tuple = tokens.verify(token)
+
+    # Forged, malformed, expired or someone else's.
+    if (claims == None or claims[0] != username or not await command.users.user_exists(username)):
+        await command.code(UserCodes.Errors.TokenInvalid)
+        return False
+
+    # Revoked by a logout since it was issued.
+    if (claims[1] != (await command.users.get_user_settings(username)).get("!tokengen", 0)):
+        await command.code(UserCodes.Errors.TokenInvalid)
+        return False
+
+    return True
+
+
+async def initial_user_signin(command: DelegateCommand) -> bool:
+    username: str = command.body["username"]
+    password: str = command.body.get("password")
+    token: str = command.body.get("token")
+    event: bool = command.body["event"]
+    tfa: str = command.body.get("2fa")
+
+    # A resume token from an earlier sign-in stands in for the password, and for 2FA,
+    # which was passed back then. Checking it is a single HMAC instead of argon2.
+    if (token != None):
+        if (not await token_signin(command, username, token)):
+            return False
+
+    elif (password == None):
+        await command.code(CommandCodes.ArgsMissing)
+        return False
+
+    else:
+        if (not await password_signin(command, username, password, tfa)):
             return False
 
 
     # Must be an initial normal connection before an event connection can be
     # achieved.
     if (event and not command.users.user_online(username)):
-        await command.connection.code(UserCodes.Errors.Event)
+        await command.code(UserCodes.Errors.Event)
         return False
 
+    metrics.signins.inc(value = "token" if token != None else "password")
     return True
 
 
@@ -122,39 +165,44 @@ async def reportmsg_command(command: DelegateCommand):
 
 
 async def user_register(command: DelegateCommand) -> bool:
-    try:
-        username = command.body["username"]
-        password = command.body["password"]
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return False
-
+    username: str = command.body["username"]
+    password: str = command.body["password"]
 
     # Username is not within the server's length constraints.
     if (not within_range(len(username), *config.UserRegulations.Length)):
-        await command.connection.code(UserCodes.Errors.UsernameLength)
+        await command.code(UserCodes.Errors.UsernameLength)
         return False
 
     # Username is not within the server's REGEX requirements.
     if (not regex_test(config.UserRegulations.Regex, username)):
-        await command.connection.code(UserCodes.Errors.UsernameRegex)
+        await command.code(UserCodes.Errors.UsernameRegex)
         return False
 
     # Password not within the length requirements.
     if (not within_range(len(password), *config.UserRegulations.PasswordLength)):
-        await command.connection.code(UserCodes.Errors.WeakPassword)
+        await command.code(UserCodes.Errors.WeakPassword)
         return False
 
     udb = users.UserDb(command.instance, username)
     
     # User already exists; cannot register them.
-    if (udb.exists()):
-        await command.connection.code(UserCodes.Errors.UsernameExists)
+    if (await udb.exists()):
+        await command.code(UserCodes.Errors.UsernameExists)
         return False
 
 
-    udb.register(password)
+    # Too many passwords are already waiting to be hashed.
+    try:
+        registered: bool = await udb.register(password)
+
+    except hashing.Saturated:
+        await command.code(ServerCodes.Error.Busy)
+        return False
+
+    # Someone else took the username while the password was being hashed.
+    if (not registered):
+        await command.code(UserCodes.Errors.UsernameExists)
+        return False
     
     return True
 
@@ -162,60 +210,41 @@ async def user_register(command: DelegateCommand) -> bool:
 
 
 async def usend_command(command: DelegateCommand):
-    try:
-        to = command.body["username"]
-        contents = command.body["message"]
-        kind = command.body["type"] if "type" in command.body else None
-        format = command.body["format"] if "format" in command.body else None
-
-        checking = [to, contents, kind, format]
-        for check in checking:
-            # Every single argument above must be type 'str'
-            if (not isinstance(check, str)):
-                # Format and kind can be null
-                if (check in [format, kind]):
-                    if (check == None):
-                        continue
-
-                await command.connection.code(CommandCodes.InvalidTypes)
-                return
+    to: str = command.body["username"]
+    contents: str = command.body["message"]
+    kind: str = command.body.get("type")
+    format: str = command.body.get("format")
 
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
-
-
-    udb = users.UserDb(command.instance, to)
 
     # User does not exist!!11111
-    if (not udb.exists()):
-        await command.connection.code(UserCodes.Errors.UsernameNoent)
+    if (not await command.users.user_exists(to)):
+        await command.code(UserCodes.Errors.UsernameNoent)
         return
 
 
     # The user has blocked you, so you may not send messages to them.
-    if (command.user.has_me_blocked(to)):
-        await command.connection.code(UserCodes.Errors.UserBlocked)
+    if (await command.user.has_me_blocked(to)):
+        await command.code(UserCodes.Errors.UserBlocked)
         return 
 
-    other_settings: dict = command.users.get_user_settings(to)
+    other_settings: dict = await command.users.get_user_settings(to)
 
     # Cannot message them, no matter what
     if (other_settings["&asocial"]):
-        await command.connection.code(UserCodes.Errors.CantSendMessage)
+        await command.code(UserCodes.Errors.CantSendMessage)
         return
 
     # Cannot send a message to them, because we are not friends.
     if (other_settings["&friends_only"] and not command.user.friends_with(to)):
-        await command.connection.code(UserCodes.Errors.CantSendMessage)
+        await command.code(UserCodes.Errors.CantSendMessage)
         return
 
 
     # Cannot send a message to them because we don't share a channel.
     if (not other_settings["&friendly"] 
-            and not command.users.two_users_in_channel(command.user.username, to)):
+            and not await command.users.two_users_in_channel(command.user.username, to)):
 
-        await command.connection.code(UserCodes.Errors.CantSendMessage)
+        await command.code(UserCodes.Errors.CantSendMessage)
         return
 
     # Make a message object
@@ -228,9 +257,8 @@ async def usend_command(command: DelegateCommand):
         to = to
     )
 
-    # Send a live event to the other user, if they are online.
-    if ((to_user := command.instance.users.get_user(to)) != None):
-        await command.user.send_message(to_user, msg)
+    # Send a live event to the other user, if they are online (on any worker).
+    await command.users.send_event(to, "message", msg.to_dict())
 
     # Store the message in the database.
     
@@ -240,17 +268,7 @@ async def usend_command(command: DelegateCommand):
 
 
 async def get_command(command: DelegateCommand):
-    try:
-        settings: list = command.body["settings"]
-
-        # Settings must be an array.
-        if (not isinstance(settings, list)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    settings: list = command.body["settings"]
 
     
     result = {
@@ -264,22 +282,12 @@ async def get_command(command: DelegateCommand):
 
         result[setting] = command.instance.constants[setting]
 
-    await command.connection.code(ServerCodes.Success.Get, {
+    await command.code(ServerCodes.Success.Get, {
         "settings": result
     })
 
 async def uset_command(command: DelegateCommand):
-    try:
-        settings: dict = command.body["settings"]
-
-        # Must be a dictionary.
-        if (not isinstance(settings, dict)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    settings: dict = command.body["settings"]
 
     special_settings = {
 
@@ -295,8 +303,8 @@ async def uset_command(command: DelegateCommand):
         key: str = key
 
         # Trying to modify an immutable setting.
-        if (key[0] in [SettingQualifiers.Immutable, SettingQualifiers.ImmutablePrivate]):
-            await command.connection.code(SettingCodes.Errors.Immutable)
+        if (key[:1] in [SettingQualifiers.Immutable, SettingQualifiers.ImmutablePrivate]):
+            await command.code(SettingCodes.Errors.Immutable)
             return
 
         # A regulated user setting
@@ -304,7 +312,7 @@ async def uset_command(command: DelegateCommand):
             info: SettingInfo = users.setting_infos[key]
 
             # Test if it passed the regulations.
-            if (not await info.test(existing_settings, command.connection, key, value)):
+            if (not await info.test(existing_settings, command, key, value)):
                 return
 
             # Add this to the list of special settings we need to send events for
@@ -327,29 +335,21 @@ async def uset_command(command: DelegateCommand):
         
     
 async def uget_command(command: DelegateCommand):
-    try:
-        settings: list = command.body["settings"]
-        username: str = command.body["username"]
-
+    settings: list = command.body["settings"]
 
-        # Must be specific type.
-        if (not isinstance(settings, list)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
+    # Username may be *null* to signify that we are obtaining from ourselves.
+    username: str = command.body["username"]
 
-        # Username may be *null* to signify that we are obtaining from ourselves.
-        if (username != None and not isinstance(username, str)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
 
+    # Obtain the settings of the user whether or not they are online.
+    # Do it in a way such that it is cached, hence the long function below.
+    # It also tells whether they exist, in the same round trip.
+    target: str = command.user.username if username == None else username
+    users_settings: dict = (await command.users.get_many_user_settings([target])).get(target)
 
     # If the username does not exist.
-    if (username != None and not command.users.user_exists(username)):
-        await command.connection.code(UserCodes.Errors.UsernameNoent)
+    if (users_settings == None):
+        await command.code(UserCodes.Errors.UsernameNoent)
         return
 
 
@@ -357,25 +357,19 @@ async def uget_command(command: DelegateCommand):
 
     }
 
-    # Obtain the settings of the user whether or not they are online.
-    # Do it in a way such that it is cached, hence the long function below.
-    users_settings = command.instance.users.get_user_settings(
-        command.user.username if username == None else username
-    )
-
     for setting in settings:
         if (username != None):
 
             # If not operating on themselves and trying to access private settings
             # disallow them from doing so, by yielding an error.
             # Stating which settings were private is NOT needed, since it is readily apparent.
-            if (setting[0] in [SettingQualifiers.Private, SettingQualifiers.ImmutablePrivate]):
-                await command.connection.code(SettingCodes.Errors.Private)
+            if (setting[:1] in [SettingQualifiers.Private, SettingQualifiers.ImmutablePrivate]):
+                await command.code(SettingCodes.Errors.Private)
                 return
 
             # If the command is private based off of the volition of the user.
-            if (command.users.is_private(username, command.user.username, setting)):
-                await command.connection.code(SettingCodes.Errors.Private)
+            if (await command.users.is_private(username, command.user.username, setting)):
+                await command.code(SettingCodes.Errors.Private)
                 return
 
 
@@ -389,7 +383,7 @@ async def uget_command(command: DelegateCommand):
 
 
     # Send back the settings that were received.
-    await command.connection.code(UserCodes.Success.Settings, {
+    await command.code(UserCodes.Success.Settings, {
         "username": username,
         "settings": result
     })
@@ -397,22 +391,13 @@ async def uget_command(command: DelegateCommand):
 
 
 async def upriv_command(command: DelegateCommand):
-    try:
-        settings: dict = command.body["settings"]
-
-        if (not isinstance(settings, dict)):
-            await command.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.code(CommandCodes.ArgsMissing)
-        return
+    settings: dict = command.body["settings"]
 
     # Go through each command to toggle privacy settings.
     for key, value in settings.items():
         # Prefixed settings cannot be used with this command.
         # No return necessary, since it's immediately obvious which are prefixed.
-        if (key[0] in ["$", "&", "!"]):
+        if (key[:1] in ["$", "&", "!"]):
             await command.code(SettingCodes.Errors.Prefixed)
             return
 
@@ -435,19 +420,10 @@ async def upriv_command(command: DelegateCommand):
         command.user.private_a_setting(key, value)
 
     # Queue a user state change only after all of this bullshit has occurred.
-    command.user.queue_state_change()
+    command.user.queue_state_change("!privatedsettings")
 
 async def uprivwhitelist_command(command: DelegateCommand):
-    try:
-        settings: dict = command.body["settings"]
-
-        if (not isinstance(settings, dict)):
-            await command.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.code(CommandCodes.ArgsMissing)
-        return
+    settings: dict = command.body["settings"]
 
     
     for key, value in settings.items():
@@ -478,72 +454,46 @@ async def uprivwhitelist_command(command: DelegateCommand):
         command.user.private_whitelist(key, value)
     
     # Queue the state change manually. See the docstring of private_whitelist.
-    command.user.queue_state_change()
+    command.user.queue_state_change("!privatewhitelist")
 
 
 
 async def frequest_command(command: DelegateCommand):
-    try:
-        username = command.body["username"]
-        message = None if message not in command.body else command.body["message"]
-    
-        # Detect invalid types.
-        if (not isinstance(username, str) or (message != None and not isinstance(message, str))):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    username: str = command.body["username"]
+    message: str = command.body.get("message")
 
     # Check if the user exists.
-    if (not command.users.user_exists(username)):
-        await command.connection.code(UserCodes.Errors.UsernameNoent)
+    if (not await command.users.user_exists(username)):
+        await command.code(UserCodes.Errors.UsernameNoent)
         return
 
-    their_settings: dict = command.users.get_user_settings(username)
+    their_settings: dict = await command.users.get_user_settings(username)
     
 
     # Nobody can become friends with them.
     if (their_settings["&lone"]):
-        await command.connection.code(UserCodes.Errors.CantBecomeFriends)
+        await command.code(UserCodes.Errors.CantBecomeFriends)
         return
 
 
     # Cannot become friends due to the other user's skepticism.
     if (their_settings["&skeptic"] 
-            and not command.users.two_users_in_channel(username, command.user.username)):
+            and not await command.users.two_users_in_channel(username, command.user.username)):
 
-        await command.connection.code(UserCodes.Errors.CantBecomeFriends)
+        await command.code(UserCodes.Errors.CantBecomeFriends)
         return
 
     await command.user.send_friendreq(username, message)
 
 
 async def friend_command(command: DelegateCommand):
-    try:
-        username: str = command.body["username"]
-        accept: bool = command.body["accept"]
-        notify: bool = command.body["notify"]
-
-        # Enforce types.
-        # We could abstract/simplify this, but honestly it's better like this...
-        if (not isinstance(username, str) 
-            or not isinstance(accept, bool)
-            or not isinstance(notify, bool)):
-
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-        
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    username: str = command.body["username"]
+    accept: bool = command.body["accept"]
+    notify: bool = command.body["notify"]
 
     # If the user does not exist.
     if (username not in command.user.friend_requests):
-        await command.connection.code(UserCodes.Errors.FriendRequestNoent)
+        await command.code(UserCodes.Errors.FriendRequestNoent)
         return
 
     # Accept or deny the friend request.
@@ -551,58 +501,35 @@ async def friend_command(command: DelegateCommand):
 
 
 async def usubscribe_command(command: DelegateCommand):
-    try:
-        username: str = command.body["username"]
-        subscribe: bool = command.body["subscribe"]
-
-        # Check types, as always.
-        if (not isinstance(username, str) or not isinstance(subscribe, bool)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-    
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    username: str = command.body["username"]
+    subscribe: bool = command.body["subscribe"]
 
     # Add a user subscription
     if (subscribe):
         # Cannot subscribe if already subscribed to.
         if (command.user.is_subscribedto(username)):
-            await command.connection.code(UserCodes.Errors.SubscriptionError)
+            await command.code(UserCodes.Errors.SubscriptionError)
             return
 
-        command.user.subscribe_to(username)
+        await command.user.subscribe_to(username)
 
     # Remove a user subscription
     else:
         # Cannot unsubscribe if not already subscribed to.
         if (not command.user.is_subscribedto(username)):
-            await command.connection.code(UserCodes.Errors.SubscriptionError)
+            await command.code(UserCodes.Errors.SubscriptionError)
             return
 
-        command.user.unsubscribe_to(username)
+        await command.user.unsubscribe_to(username)
         
 
 
 # in construction, moved to Phase III
 async def umsgquery_command(command: DelegateCommand):
-    try:
-        username: str = command.body["username"]
-        query: dict = command.body["query"]
-        page_len: int = command.body["page_len"]
-        timestamp: int = command.body["timestamp"] if "timestamp" in command.body else None
-
-        # New anti-boilerplate feature.
-        if (not type_test([username, query, page_len], [str, dict, int]) 
-            or (not isinstance(timestamp, int) and timestamp != None)):
-
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
-
-
-    except KeyError:
-        await command.connection.code(CommandCodes.ArgsMissing)
-        return
+    username: str = command.body["username"]
+    query: dict = command.body["query"]
+    page_len: int = command.body["page_len"]
+    timestamp: int = command.body.get("timestamp")
 
 
     
@@ -616,25 +543,15 @@ async def ueventquery_command(command: DelegateCommand):
 async def tfa_command(command: DelegateCommand):
     udb: users.UserDb = users.UserDb(command.instance, command.user.username)
 
-    await command.connection.code(UserCodes.Success.TwoFactor, {
-        "secret": udb.update_2fa()
+    await command.code(UserCodes.Success.TwoFactor, {
+        "secret": await udb.update_2fa()
     })
 
 # Channel Commands
 
 async def cregister_command(command: DelegateCommand):
-    try:
-        channel: str = command.body["channel"]
-        group: bool = command.body["group"]
-
-        # Incorrect type: channel must be 'str'; group must be 'bool'
-        if (not isinstance(channel, str) or not isinstance(group, bool)):
-            await command.code(CommandCodes.InvalidTypes)
-            return
-
-    except KeyError:
-        await command.code(CommandCodes.ArgsMissing)
-        return
+    channel: str = command.body["channel"]
+    group: bool = command.body["group"]
 
     # Channel name length not within perscribed length range--more list unpacking, too!
     if (not within_range(len(channel), *config.ChannelRegulations.Length)):
@@ -642,33 +559,86 @@ async def cregister_command(command: DelegateCommand):
         return
 
     # Channel name did not pass the REGEX test.
-    if (not regex_test(channel, config.ChannelRegulations.Regex)):
+    if (not regex_test(config.ChannelRegulations.Regex, channel)):
         await command.code(ChannelCodes.Errors.Regex)
         return
 
     cdb = channels.ChannelDb(command.instance, channel)
 
     # Already exists
-    if (cdb.exists()):
+    if (await cdb.exists()):
+        await command.code(ChannelCodes.Errors.AlreadyExists)
+        return
+
+
+    # Someone else registered it since it was checked.
+    if (not await cdb.register(command.user.username, group)):
         await command.code(ChannelCodes.Errors.AlreadyExists)
         return
 
+    await command.users.append_user_settings(command.user.username, "!channels", [channel])
 
-    cdb.register(command.user.username, group)
+    await command.code(ChannelCodes.Success.Register)
 
     
 
-async def udelete_command(command: DelegateCommand):
-    try:
-        password: str = command.body["password"]
+async def csend_command(command: DelegateCommand):
+    name: str = command.body["channel"]
+    subchannel: str = command.body["subchannel"]
+    contents: str = command.body["message"]
+    kind: str = command.body.get("type")
+    format: str = command.body.get("format")
 
-        if (not isinstance(password, str)):
-            await command.connection.code(CommandCodes.InvalidTypes)
-            return
+    username: str = command.user.username
 
-    except IndexError:
-        await command.connection.code(CommandCodes.ArgsMissing)
+    if (not within_range(len(contents), *config.MessageRegulations.Length)):
+        await command.code(ChannelCodes.Errors.MessageLength)
         return
+
+    # Everything from here on is answered from the channel in memory.
+    if (not await command.channels.channel_exists(name)):
+        await command.code(ChannelCodes.Errors.Noent)
+        return
+
+    channel: channels.Channel = await command.channels.get_channel(name)
+
+    if (username not in channel.users):
+        await command.code(ChannelCodes.Errors.NotInChannel)
+        return
+
+    # A private subchannel they cannot see might as well not exist.
+    if (subchannel not in channel.subchannels or not channel.can_see(username, subchannel)):
+        await command.code(ChannelCodes.Errors.SubchannelNoent)
+        return
+
+    if (not channel.has_permission(username, channels.ChannelPermissions.Talk, subchannel)):
+        await command.code(ChannelCodes.Errors.LackPermissions)
+        return
+
+    if (channel.is_muted(username)):
+        await command.code(ChannelCodes.Errors.Muted)
+        return
+
+    msg = messages.Message(
+        messages.MessageOrigins.Channel,
+        username,
+        contents,
+        format,
+        kind = kind,
+        channel = name,
+        subchannel = subchannel
+    )
+
+    # Everyone online who can see the subchannel gets it live; storing it waits for the next batch.
+    await channel.broadcast_event("message", msg.to_dict(), subchannel = subchannel)
+    await command.messages.channel_message(msg)
+
+    channel.count_sent(username)
+    metrics.channel_messages.inc()
+
+
+async def udelete_command(command: DelegateCommand):
+    password: str = command.body["password"]
     
 
     #command.
@@ -685,10 +655,44 @@ commands_list = {
     "2fa": tfa_command,
     "upriv": upriv_command,
     "uprivwhitelist": uprivwhitelist_command,
-    "cregister": cregister_command
+    "cregister": cregister_command,
+    "csend": csend_command
+}
+
+
+# Commands which change the state of the user issuing them. These run one at a time per user,
+# in the order they were received, even when they are tagged to run concurrently.
+ordered_commands = {
+    "uset",
+    "upriv",
+    "uprivwhitelist",
+    "usubscribe",
+    "frequest",
+    "friend",
+    "2fa",
+    "cregister"
 }
 
 
+async def execute(command: DelegateCommand):
+    "Call the handler of a non-primitive command."
+
+    handler = commands_list[command.command]
+    started: float = metrics.now()
+
+    # Anything a user sends keeps them from going away.
+    await command.users.presence.touch(command.user)
+
+    if (command.command in ordered_commands):
+        async with command.user.lock:
+            await handler(command)
+
+    else:
+        await handler(command)
+
+    metrics.command_seconds.observe_since(started, command.command)
+
+
 # A list of commands which do not require signing into a user.
 primitive_commands = [
     "user",
@@ -697,5 +701,113 @@ primitive_commands = [
     "ping",
     "get",
     "authenticate"
-]   
-    
\ No newline at end of file
+]
+
+
+# What every command body must look like, by command name.
+# Bodies are checked against these before their handler runs, so handlers can
+# read their fields without checking them again.
+command_schemas = {
+    # Primitive commands
+    "user": {
+        "username": Field(str),
+        # One or the other.
+        "password": Field(str, required = False),
+        "token": Field(str, required = False),
+        "event": Field(bool),
+        "2fa": Field(str, required = False, nullable = True)
+    },
+
+    "uregister": {
+        "username": Field(str),
+        "password": Field(str)
+    },
+
+    "authenticate": {
+        "password": Field(str)
+    },
+
+    "get": {
+        "settings": Field(list, of = str)
+    },
+
+    "quit": {},
+    "ping": {},
+    "logout": {},
+
+    # Non-primitive commands
+    "usend": {
+        "username": Field(str),
+        "message": Field(str),
+        "type": Field(str, required = False, nullable = True),
+        "format": Field(str, required = False, nullable = True)
+    },
+
+    "uset": {
+        "settings": Field(dict)
+    },
+
+    "uget": {
+        "settings": Field(list, of = str),
+        "username": Field(str, nullable = True)
+    },
+
+    "usubscribe": {
+        "username": Field(str),
+        "subscribe": Field(bool)
+    },
+
+    "frequest": {
+        "username": Field(str),
+        "message": Field(str, required = False, nullable = True)
+    },
+
+    "friend": {
+        "username": Field(str),
+        "accept": Field(bool),
+        "notify": Field(bool)
+    },
+
+    "2fa": {},
+
+    "upriv": {
+        "settings": Field(dict)
+    },
+
+    "uprivwhitelist": {
+        "settings": Field(dict)
+    },
+
+    "cregister": {
+        "channel": Field(str),
+        "group": Field(bool)
+    },
+
+    "csend": {
+        "channel": Field(str),
+        "subchannel": Field(str),
+        "message": Field(str),
+        "type": Field(str, required = False, nullable = True),
+        "format": Field(str, required = False, nullable = True)
+    },
+
+    "umsgquery": {
+        "username": Field(str),
+        "query": Field(dict),
+        "page_len": Field(int),
+        "timestamp": Field(int, required = False, nullable = True)
+    },
+
+    "udelete": {
+        "password": Field(str)
+    }
+}
+
+# Fields that any command may have.
+common_schema = {
+    # Tags the command to run concurrently with other tagged commands.
+    "id": Field(str, int, required = False, nullable = True)
+}
+
+# Compiled once, at import.
+validators = schemas.compile_schemas(command_schemas, common_schema)
@@ -25,6 +25,44 @@ class Networking:
     HTTP = 9997
     HTTPS = 9996
 
+class Workers:
+    # Number of server processes sharing the listening port (--workers overrides it).
+    Count = 1
+
+    # The unix socket the workers use to route events to each other.
+    BrokerPath = "/tmp/delegate-broker.sock"
+
+class Outbound:
+    # Frames that may wait on one event connection before the policy kicks in.
+    QueueSize = 256
+
+    # See OutboundPolicies
+    Policy = OutboundPolicies.Coalesce
+
+class Serialization:
+    # "orjson" when it is installed, otherwise the standard library "json" is used.
+    Codec = "orjson"
+
+class Hashing:
+    # Processes that hash and verify passwords (argon2), away from the event loop.
+    Workers = 2
+
+    # Sign-ins and registrations that may wait for one of those processes.
+    # Any more than this are turned away with ServerCodes.Error.Busy.
+    MaxPending = 64
+
+class Metrics:
+    # Serve Prometheus metrics on Networking.HTTP and record them.
+    # When off, recording a sample is close to free.
+    Enabled = False
+
+    # With several workers, worker N serves its metrics on WorkerPortBase + N instead.
+    WorkerPortBase = 9900
+
+class Pipelining:
+    # Tagged commands that may run at the same time on one connection.
+    MaxConcurrent = 8
+
 class ServerRegulations:
     MaxMessageLength = 4096
     Timeout = 60*15
@@ -44,6 +82,59 @@ class Database:
     Name = "delegatetest"
     Host = "/tmp"
 
+    # Number of pooled connections, which is also the number of queries that can
+    # run at the same time.
+    PoolSize = 8
+
+class UserStateWrites:
+    # Changed user state is written to the database at least this often (seconds)...
+    Interval = 0.25
+
+    # ...or as soon as this many users are waiting, which is also the most one statement writes.
+    BatchSize = 500
+
+class Caching:
+    # Settings of offline users kept in memory, so checks against them skip the database.
+    SettingsSize = 10000
+
+    # Seconds before a cached entry has to be read from the database again.
+    SettingsTTL = 5*MINUTE
+
+    # Users whose blocks, friends and channels are indexed for checks between two users.
+    GraphSize = 10000
+
+    # Seconds before an indexed user is read again, should a change have been missed.
+    GraphTTL = 5*MINUTE
+
+class Tokens:
+    # Seconds that a resume token, issued on every sign-in, may be used instead of the password.
+    Lifetime = DAY
+
+    # What tokens are signed with. Every worker has to share it. When None, one is made
+    # at startup and handed down to the workers, so tokens stop working once the server restarts.
+    Secret = None
+
+class ChannelStateWrites:
+    # Changed channel state is written to the database at least this often (seconds)...
+    Interval = 1
+
+    # ...or as soon as this many channels are waiting, which is also the most one transaction writes.
+    BatchSize = 200
+
+class ChannelEviction:
+    # Channels without online members are unloaded once nobody has asked for them this long.
+    IdleTime = 10*MINUTE
+
+    # Seconds between looks for such channels.
+    Interval = MINUTE
+
+class ChannelMessageWrites:
+    # Channel messages are stored at least this often (seconds)...
+    Interval = 0.25
+
+    # ...or as soon as this many are waiting, which is also the most one statement inserts.
+    BatchSize = 1000
+
 class ServerPassword:
     On = False
     Password = "aserverpassword"
@@ -51,6 +142,22 @@ class ServerPassword:
 class UserSettings:
     UserAwayTime = 10*MINUTE
 
+    # Idle users who have been away this long (since their last action) appear offline.
+    UserOfflineTime = HOUR
+
+class Events:
+    # Seconds over which special setting changes of one user are merged into one uspecial event.
+    # 0 sends every change right away.
+    SpecialWindow = 0.25
+
+class Presence:
+    # Seconds between checks for users whose idle deadline has passed.
+    Interval = 1
+
+class Expiry:
+    # Seconds between checks for bans and mutes that ran out.
+    Interval = 1
+
 class UserRegulations:
     Length = [3, 24]
     Regex = "[a-zA-Z0-9-.]"
@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import psycopg2
+import psycopg2.pool
+
+import config
+
+
+class Database:
+    """A bounded gateway to the database.
+    Queries run on a pool of worker threads, each borrowing one connection from a pool
+    of the same size, so a slow query only ever occupies one worker instead of the event loop.
+    """
+
+    def __init__(self, size: int = config.Database.PoolSize):
+        self.size: int = size
+        self.pool: psycopg2.pool.ThreadedConnectionPool = None
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = size,
+            thread_name_prefix = "delegate-db"
+        )
+
+
+    def open(self):
+        "Open the connection pool. Blocks, so call it before the event loop gets busy."
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            self.size,
+            self.size,
+            host = config.Database.Host,
+            dbname = config.Database.Name,
+            user = config.Database.Username,
+            password = config.Database.Password
+        )
+
+    def close(self):
+        "Wait for running queries, then close every pooled connection."
+
+        self.executor.shutdown(wait = True)
+
+        if (self.pool != None):
+            self.pool.closeall()
+
+
+    def _transaction(self, function, *args):
+        "Run function(cursor, *args) on a pooled connection inside of one transaction. [WORKER THREAD]"
+
+        connection = self.pool.getconn()
+        broken: bool = False
+
+        try:
+            with connection.cursor() as cursor:
+                result = function(cursor, *args)
+
+            connection.commit()
+            return result
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The server dropped the connection, don't hand it to the next query.
+            broken = True
+            raise
+
+        except Exception:
+            connection.rollback()
+            raise
+
+        finally:
+            self.pool.putconn(connection, close = broken or connection.closed != 0)
+
+
+    async def run(self, function, *args):
+        "Run function(cursor, *args) in a single transaction without blocking the event loop."
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._transaction, function, *args)
+
+
+    async def execute(self, query: str, args: tuple = None):
+        "Execute a statement and commit it."
+
+        def execute(cursor):
+            cursor.execute(query, args)
+
+        await self.run(execute)
+
+    async def fetchone(self, query: str, args: tuple = None) -> tuple:
+        "Execute a query and return the first row, or None."
+
+        def fetchone(cursor):
+            cursor.execute(query, args)
+            return cursor.fetchone()
+
+        return await self.run(fetchone)
+
+    async def fetchall(self, query: str, args: tuple = None) -> list:
+        "Execute a query and return every row."
+
+        def fetchall(cursor):
+            cursor.execute(query, args)
+            return cursor.fetchall()
+
+        return await self.run(fetchall)
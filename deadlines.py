@@ -0,0 +1,72 @@
+import asyncio
+import heapq
+import itertools
+
+from util import *
+
+
+class DeadlineScheduler:
+    def __init__(self, name: str, interval: float):
+        """A heap of deadlines, by key, that is checked every interval.
+        Every key has at most one live entry. Rescheduling or forgetting a key leaves its old entry in the heap,
+        to be skipped once it comes up, so both are O(log n) at most and nothing is ever scanned.
+        Subclasses implement tick(), which takes what is due() and acts on it.
+        """
+
+        self.name: str = name
+        self.interval: float = interval
+
+        # (deadline, generation, key)
+        self.heap: list = []
+
+        # key -> generation of its one live heap entry. Older entries are skipped.
+        self.generations: dict = {}
+        self.counter = itertools.count()
+
+        self.task: asyncio.Task = None
+
+
+    def schedule(self, key, deadline: float):
+        generation: int = next(self.counter)
+
+        self.generations[key] = generation
+        heapq.heappush(self.heap, (deadline, generation, key))
+
+    def forget(self, key):
+        "Stop tracking a key. Its heap entry is skipped once it comes up."
+
+        self.generations.pop(key, None)
+
+
+    def due(self, now: float):
+        "Pop every live entry whose deadline has passed, yielding its key. Entries scheduled meanwhile count too."
+
+        while self.heap != [] and self.heap[0][0] <= now:
+            deadline, generation, key = heapq.heappop(self.heap)
+
+            if (self.generations.get(key) == generation):
+                yield key
+
+
+    async def tick(self):
+        raise NotImplementedError
+
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.tick()
+
+            except Exception as error:
+                eprint(f"Error {self.name}: {error}")
+
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if (self.task != None):
+            self.task.cancel()
+            self.task = None
@@ -4,12 +4,33 @@ MINUTE = 60
 HOUR = MINUTE * 60
 DAY = HOUR * 24
 
+# The duration of a channel ban or mute that never runs out.
+FOREVER = 0
+
+class OutboundPolicies:
+    "What to do with a connection whose outbound queue is full."
+
+    # Discard the new frame.
+    Drop = "drop"
+
+    # Replace a pending frame with the same key, otherwise discard the oldest frame.
+    Coalesce = "coalesce"
+
+    # Close the connection.
+    Disconnect = "disconnect"
+
+class UserStatuses:
+    Online = 0
+    Away = 1
+    Offline = 2
+
 class ServerCodes:
     class Success:
         Connection = 0
         Ping = 1
         Get = 2
         Authentication = 3
+        Done = 4
 
     class Error:
         NotOpen = -1
@@ -24,6 +45,7 @@ class ServerCodes:
         NoParameter = -11
         DontCare = -12
         NotImplemented = -13
+        Busy = -14
 
 class UserCodes:
     class Success:
@@ -56,6 +78,7 @@ class UserCodes:
         SubscriptionError = -118
         NotFriends = -119
         Event = -120
+        TokenInvalid = -121
 
 class ChannelCodes:
     class Success:
@@ -87,6 +110,8 @@ class ChannelCodes:
         InChannelAlready = -218
         JoinIncorrect = -219
         MainError = -220
+        Muted = -221
+        MessageLength = -222
 
 class CommandCodes:
     ArgsMissing = -300
@@ -1,12 +1,18 @@
 import asyncio
+import collections
 import websockets
 import websockets.exceptions as wes
-import json
-import psycopg2
+import codec
 import traceback
 
 import config
 import commands
+import database
+import broker
+import metrics
+import hashing
+import registry
+import tokens
 
 import users
 import channels
@@ -29,11 +35,35 @@ class Connection:
 
         self.websocket = websocket
 
-    #def _identity(self) -> str:
-    #    return self.websocket.remote_address
+        # Given by the ConnectionRegistry, and never reused.
+        self.id: int = None
+        self.opened: float = None
 
-    #def __eq__(self, another):
-    #    return self._identity == another._identity
+        # Who is signed in on it, and whether it only receives events.
+        self.username: str = None
+        self.event: bool = False
+
+        # Where it comes from; None for a unix socket.
+        self.host: str = websocket.remote_address[0] if websocket.remote_address else None
+
+        # Events wait here for their own writer task, so that one slow client
+        # never holds up delivery to everyone else.
+        self.outbound: collections.deque = collections.deque()
+        self.outbound_ready: asyncio.Event = asyncio.Event()
+        self.writer: asyncio.Task = None
+
+        # Frames that are still waiting, by their coalescing key.
+        self.pending: dict = {}
+
+        # Whether the connection is being dropped for being too slow, or is gone. Nothing is queued then.
+        self.closing: bool = False
+        self.closer: asyncio.Task = None
+
+        # Queue statistics
+        self.peak: int = 0
+        self.sent: int = 0
+        self.dropped: int = 0
+        self.coalesced: int = 0
 
     async def code(self, code: int, body: dict = {}):
         "Issue a response code to the socket in question."
@@ -43,81 +73,177 @@ class Connection:
         }
 
         code_body.update(body)
-        await self.websocket.send(json.dumps(code_body))
+        await self.websocket.send(codec.encode_text(code_body))
+
+
+    def push(self, frame: str, key: str = None):
+        """Queue an encoded frame for the writer task without waiting for it to be sent.
+        Frames sharing a key supersede each other under the coalesce policy.
+        """
+
+        if (self.closing):
+            self.dropped += 1
+            return
+
+        policy: str = config.Outbound.Policy
+
+        # A newer version of a frame that has not been sent yet takes its place.
+        if (key != None and policy == OutboundPolicies.Coalesce and key in self.pending):
+            self.pending[key][1] = frame
+            self.coalesced += 1
+            return
+
+        # The client is not keeping up.
+        if (len(self.outbound) >= config.Outbound.QueueSize):
+            if (policy == OutboundPolicies.Drop):
+                self.dropped += 1
+                return
+
+            if (policy == OutboundPolicies.Disconnect):
+                self.dropped += len(self.outbound) + 1
+                self.outbound.clear()
+                self.pending.clear()
+                self.closing = True
+
+                # Held on to, so that it is not collected before it runs.
+                self.closer = asyncio.create_task(self.close())
+                return
+
+            # Coalesce: make room by giving up the oldest frame.
+            oldest = self.outbound.popleft()
+            if (oldest[0] != None):
+                self.pending.pop(oldest[0], None)
+
+            self.dropped += 1
+
+        entry: list = [key, frame]
+        self.outbound.append(entry)
+
+        if (key != None):
+            self.pending[key] = entry
+
+        self.peak = max(self.peak, len(self.outbound))
+        self.outbound_ready.set()
+
+        if (self.writer == None):
+            self.writer = asyncio.create_task(self.write_outbound())
+
+
+    async def write_outbound(self):
+        "Send queued frames, one after another, until the socket closes."
+
+        while True:
+            while (not self.outbound):
+                self.outbound_ready.clear()
+                await self.outbound_ready.wait()
+
+            key, frame = self.outbound.popleft()
+            if (key != None):
+                self.pending.pop(key, None)
+
+            try:
+                await self.websocket.send(frame)
+
+            # Nothing will drain the queue anymore, so stop filling it.
+            except wes.ConnectionClosed:
+                self.closing = True
+                self.outbound.clear()
+                self.pending.clear()
+                self.writer = None
+                return
+
+            self.sent += 1
+
+
+    def stats(self) -> dict:
+        "Outbound queue statistics of this connection."
+
+        return {
+            "depth": len(self.outbound),
+            "peak": self.peak,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced
+        }
+
+
+    def stop(self):
+        "Stop the writer task; whatever is still queued is discarded, and nothing more is queued."
+
+        self.closing = True
+        self.outbound.clear()
+        self.pending.clear()
+
+        if (self.writer != None):
+            self.writer.cancel()
+            self.writer = None
 
 
     async def close(self):
         "Close the socket"
 
+        self.stop()
         await self.websocket.close()
 
 
 
 
-class DelegateServer:
-    def __init__(self, hostip, port: int, tls: bool):
-        self.hostip = hostip
-        self.port: int = port
-        self.tls: bool = tls
+class Pipeline:
+    def __init__(self, instance, limit: int = config.Pipelining.MaxConcurrent):
+        "Runs the tagged commands of one connection concurrently, up to a limit."
 
+        self.instance = instance
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(limit)
+        self.tasks: set = set()
 
+    async def submit(self, command: DelegateCommand):
+        "Start running a command. Waits while the connection already has too many running."
+
+        # Nothing more is read from the socket until a slot frees up.
+        await self.slots.acquire()
+
+        task: asyncio.Task = asyncio.create_task(self.run(command))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, command: DelegateCommand):
         try:
-            self.database = psycopg2.connect(
-                host = config.Database.Host,
-                dbname = config.Database.Name, 
-                user = config.Database.Username, 
-                password = config.Database.Password
-            )
+            await self.instance.run_command(command)
 
-        except Exception as error:
-            eprint(f"Error connecting to database: {error}")
+            # Many commands are silent when they succeed, but a tagged command
+            # always tells the client when it has finished.
+            if (not command.responded):
+                await command.code(ServerCodes.Success.Done)
 
+        finally:
+            self.slots.release()
 
-        self.cursor = self.database.cursor()
-        
-        # Create the databases if they do not already exist
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS Users"
-            "(username TEXT, created INTEGER, settings TEXT, passhash TEXT, tfa TEXT DEFAULT NULL);"
-        ))
+    def cancel(self):
+        "Cancel every command that is still running."
 
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS Channels"
-            "(channel TEXT, created INTEGER, state TEXT);"
-        ))
+        for task in self.tasks:
+            task.cancel()
 
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS ChannelQueryables"
-            "(channel TEXT, queryable TEXT, value_str TEXT, value_int INTEGER, value_bool BOOLEAN); "
-        ))
 
 
-        # for later i guess
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS ChannelMessages"
-            "(id UUID, kind TEXT, channel TEXT, subchannel TEXT, whom TEXT, containing TEXT," 
-            "creation INTEGER, format TEXT);"
-        ))
 
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS UserMessages"
-            "(id UUID, kind TEXT, parties TEXT, whom TEXT, containing TEXT," 
-            "creation INTEGER, format TEXT);"
-        ))
+class DelegateServer:
+    def __init__(self, hostip, port: int, tls: bool, worker: int = None, db: database.Database = None):
+        self.hostip = hostip
+        self.port: int = port
+        self.tls: bool = tls
 
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS UserEvents (id UUID, event TEXT, parties TEXT,"
-            "contents TEXT);"
-        ))
+        # Which worker process this is, or None when running as the only process.
+        self.worker: int = worker
+        self.broker: broker.BrokerClient = None
 
-        self.cursor.execute((
-            "CREATE TABLE IF NOT EXISTS UserNotifications (id UUID, event TEXT, body TEXT,"
-            "origin TEXT, creation INTEGER, read BOOLEAN);"
-        ))
 
-        
-        # Save the database table creations
-        self.database.commit()
+        # Every query goes through this pool, so that none of them block the event loop.
+        # Benchmarks pass in a stand-in instead.
+        self.db: database.Database = database.Database() if db == None else db
+
+        # Password hashing happens in other processes.
+        self.hasher: hashing.PasswordHasher = hashing.PasswordHasher()
 
         
         self.messages: messages.MessagesDatabase = messages.MessagesDatabase(self)
@@ -144,20 +270,67 @@ class DelegateServer:
             "password_len": config.UserRegulations.PasswordLength
         }
 
+        # Every open connection, for logging off and admin tooling.
+        self.connections: registry.ConnectionRegistry = registry.ConnectionRegistry()
+
         self.users = users.Users(self)
         self.channels = channels.Channels(self)
 
 
+    async def create_tables(self):
+        "Create the databases if they do not already exist"
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS Users"
+            "(username TEXT PRIMARY KEY, created INTEGER, settings JSONB, passhash TEXT, tfa TEXT DEFAULT NULL);"
+        ))
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS Channels"
+            "(channel TEXT PRIMARY KEY, created INTEGER, state JSONB);"
+        ))
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS ChannelQueryables"
+            "(channel TEXT, queryable TEXT, value_str TEXT, value_int INTEGER, value_bool BOOLEAN); "
+        ))
+
+
+        # for later i guess
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS ChannelMessages"
+            "(id UUID, kind TEXT, channel TEXT, subchannel TEXT, whom TEXT, containing TEXT," 
+            "creation INTEGER, format TEXT);"
+        ))
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS UserMessages"
+            "(id UUID, kind TEXT, parties TEXT, whom TEXT, containing TEXT," 
+            "creation INTEGER, format TEXT);"
+        ))
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS UserEvents (id UUID, event TEXT, parties TEXT,"
+            "contents TEXT);"
+        ))
+
+        await self.db.execute((
+            "CREATE TABLE IF NOT EXISTS UserNotifications (id UUID, event TEXT, body TEXT,"
+            "origin TEXT, creation INTEGER, read BOOLEAN);"
+        ))
+
 
     async def handle(self, ws):
         # Make the Connection abstraction
         conn: Connection = Connection(ws)
+        pipeline: Pipeline = Pipeline(self)
+
+        self.connections.register(conn)
 
         # Store the username and User object of the request
         username = None
         user = None
         authenticated = False
-        event_listener = False
 
 
         
@@ -172,10 +345,21 @@ class DelegateServer:
                         user
                     )
 
+                    # Only JSON objects can be commands.
+                    if (command == None):
+                        await conn.code(CommandCodes.InvalidTypes)
+                        continue
+
+                    # Reject malformed commands before anything acts on them.
+                    if ((error := command.validate()) != None):
+                        await command.code(error)
+                        continue
+
                     # Quit the connection and logoff if signed in.
                     if (command.command == "quit"):
                         if (username != None):
                             await self.users.user_logoff(conn, username)
+                            user = None
 
                         await conn.close()
                         break
@@ -184,15 +368,15 @@ class DelegateServer:
                     # besides 'authenticate' and 'quit'
                     if (config.ServerPassword.On and not authenticated):
                         if (command.command != "authenticate"):
-                            await conn.code(ServerCodes.Error.PasswordRequired)
+                            await command.code(ServerCodes.Error.PasswordRequired)
                             continue
 
                     
                     # Server authentication command
                     if (command.command == "authenticate"):
                         # The password was incorrect, so alert them of that and continue.
-                        if (not commands.authenticate_command(command)):
-                            await conn.code(ServerCodes.Error.Password)
+                        if (not await commands.authenticate_command(command)):
+                            await command.code(ServerCodes.Error.Password)
                             continue
                         
                         # Authentication was a success
@@ -205,15 +389,10 @@ class DelegateServer:
                     if (command.command in commands.primitive_commands):
                         # Initial sign in
                         if (command.command == "user"):
-                            try:
-                                event: bool = command.body["event"]
-
-                            except KeyError:
-                                await conn.code(CommandCodes.ArgsMissing)
-                                continue
+                            event: bool = command.body["event"]
 
                             if (user != None):
-                                await conn.code(UserCodes.Errors.AlreadySignedIn)
+                                await command.code(UserCodes.Errors.AlreadySignedIn)
                                 continue
                             
                             # User sign in failed.
@@ -229,8 +408,18 @@ class DelegateServer:
                             )
 
                             username = command.body["username"]
+                            conn.username = username
+                            conn.event = event
 
-                            await conn.code(UserCodes.Success.Signin)
+                            # Later connections, such as the event connection or a reconnect,
+                            # can sign in with this instead of the password. Signing in with a token
+                            # hands the same one back, so that it still runs out when it was meant to.
+                            if ((token := command.body.get("token")) == None):
+                                token = tokens.issue(username, user.settings.get("!tokengen", 0))
+
+                            await command.code(UserCodes.Success.Signin, {
+                                "token": token
+                            })
 
                             
 
@@ -241,41 +430,51 @@ class DelegateServer:
                             if (not await commands.user_register(command)):
                                 continue
 
-                            await conn.code(UserCodes.Success.Register)
+                            await command.code(UserCodes.Success.Register)
                         
                         continue
 
                     # Logout
                     if (command.command == "logout"):
                         if (user == None):
-                            await conn.code(CommandCodes.NotSignedIn)
+                            await command.code(CommandCodes.NotSignedIn)
                             continue
 
+                        # Every token they were issued stops working.
+                        user.settings["!tokengen"] = user.settings.get("!tokengen", 0) + 1
+                        user.queue_state_change("!tokengen")
+
                         await self.users.user_logoff(conn, username, consensual = True)
                         user = None
                         username = None
+                        conn.username = None
                         continue
 
 
 
                     # Command was not found
                     if (command.command not in commands.commands_list):
-                        await conn.code(CommandCodes.NotFound)
+                        await command.code(CommandCodes.NotFound)
                         continue
 
                     # The user must be signed in to use this command.
                     if (user == None):
-                        await conn.code(CommandCodes.NotSignedIn)
+                        await command.code(CommandCodes.NotSignedIn)
+                        continue
+
+                    # Tagged commands run alongside each other; their responses are matched up by id.
+                    if (command.id != None):
+                        await pipeline.submit(command)
                         continue
 
                     # Call the command handler and pass in the DelegateCommand object instance.
-                    await commands.commands_list[command.command](command)
+                    await commands.execute(command)
                         
 
 
 
                 # When JSON was likely not sent or was malformed (for some reason?)
-                except json.JSONDecodeError as je:
+                except codec.DecodeError as je:
                     await conn.code(ServerCodes.Error.JSONError)
 
                 # When an unknown or general server exception was thrown
@@ -289,15 +488,74 @@ class DelegateServer:
                     eprint(traceback.format_exc())
         
         except (wes.WebSocketException, wes.ConnectionClosedError, asyncio.exceptions.IncompleteReadError):
+            pass
+
+        # However the socket went away, it is logged off right here.
+        finally:
+            pipeline.cancel()
+            conn.stop()
+            self.connections.unregister(conn)
+
             if (user != None):
-                await self.users.user_logoff(conn, user.username, event = event_listener)
+                await self.users.user_logoff(conn, username)
 
-            return
+
+    async def run_command(self, command: DelegateCommand):
+        "Call a command handler, reporting any exception back to the client."
+
+        try:
+            await commands.execute(command)
+
+        except Exception as e:
+            await command.code(ServerCodes.Error.ServerException, {
+                "exception": type(e).__name__,
+                "message": str(e)
+            })
+
+            eprint("A server exception occured while handling a command: ")
+            eprint(traceback.format_exc())
 
 
     async def main_server(self):
-        async with websockets.serve(self.handle, self.hostip, self.port):
-            await asyncio.Future()
+        try:
+            self.db.open()
+
+        except Exception as error:
+            eprint(f"Error connecting to database: {error}")
+            return
+
+        await self.create_tables()
+        self.users.start()
+        self.channels.start()
+        self.messages.start()
+
+        if (metrics.enabled):
+            port = config.Networking.HTTP if self.worker == None else config.Metrics.WorkerPortBase + self.worker
+            await metrics.serve(self.hostip, port)
+
+        # Workers route events for users connected elsewhere through the broker.
+        if (self.worker != None):
+            self.broker = broker.BrokerClient(self, self.worker)
+            await self.broker.connect()
+
+        # SO_REUSEPORT lets every worker accept on the same port.
+        try:
+            async with websockets.serve(self.handle, self.hostip, self.port, 
+                                        reuse_port = self.worker != None):
+                await asyncio.Future()
+
+        # Whatever user state has not been written yet must not be lost.
+        finally:
+            # Each on its own, user state first, so that one failing to write does not keep the others from it.
+            for stop in [self.users.stop, self.channels.stop, self.messages.stop]:
+                try:
+                    await stop()
+
+                except Exception as error:
+                    eprint(f"Error writing out state on shutdown: {error}")
+
+            self.hasher.close()
+            self.db.close()
 
     def start(self):
         asyncio.run(self.main_server())
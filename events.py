@@ -1,6 +1,7 @@
 import uuid
-import json
-import psycopg2
+import codec
+import database
+import metrics
 
 class EventOrigins:
     Server = 0
@@ -33,11 +34,11 @@ class EventDatabase:
 
     def __init__(self, instance):
         self.instance = instance
-        self.database = self.instance.database
-        self.cursor: psycopg2.cursor = self.instance.cursor
+        self.database: database.Database = self.instance.db
 
-    def user_event(self, e: Event):
-        self.cursor.execute((
+    @metrics.timed(metrics.sql_seconds)
+    async def user_event(self, e: Event):
+        await self.database.execute((
             "INSERT INTO UserEvents (id, event, parties,"
             "creation, contents) VALUES (%s, %s, %s, %s, %s);"
         ), (
@@ -45,8 +46,6 @@ class EventDatabase:
             e.name,
             e.parties,
             e.timestamp,
-            json.dumps(e.body)
+            codec.encode_text(e.body)
         ))
 
-        self.database.commit()
-
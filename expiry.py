@@ -0,0 +1,81 @@
+import time
+
+import config
+import deadlines
+import metrics
+
+from definitions import *
+from util import *
+
+
+# What can expire, by the channel setting holding the records.
+Ban = "$banned"
+Mute = "$muted"
+
+
+class ExpiryScheduler(deadlines.DeadlineScheduler):
+    def __init__(self, channels, interval: float = config.Expiry.Interval):
+        """Lifts bans and mutes of loaded channels once they run out, without ever scanning a ban list.
+        Every record with a duration has one deadline, by (channel, kind, username), in a heap shared
+        by all channels.
+        """
+
+        super().__init__("lifting bans and mutes", interval)
+
+        self.channels = channels
+
+
+    def schedule_record(self, channel: str, kind: str, username: str, record: dict):
+        "Schedule a ban or mute record to be lifted. Ones that last forever are never scheduled."
+
+        if (record["duration"] == FOREVER):
+            self.forget((channel, kind, username))
+            return
+
+        self.schedule((channel, kind, username), record["when"] + record["duration"])
+
+
+    def watch(self, channel):
+        "Schedule every ban and mute of a channel that was just loaded."
+
+        for kind in [Ban, Mute]:
+            for username, record in channel.settings[kind].items():
+                self.schedule_record(channel.name, kind, username, record)
+
+    def unwatch(self, channel):
+        "Stop watching a channel that was unloaded. Its records are scheduled again if it is loaded again."
+
+        for kind in [Ban, Mute]:
+            for username in channel.settings[kind]:
+                self.forget((channel.name, kind, username))
+
+
+    async def tick(self):
+        "Lift every ban and mute whose deadline has passed."
+
+        now: float = time.time()
+
+        for key in self.due(now):
+            name, kind, username = key
+            self.forget(key)
+
+            # Unloaded since; it is scheduled again when it is loaded.
+            if ((channel := self.channels.channels.get(name)) == None):
+                continue
+
+            try:
+                if (kind == Ban):
+                    await channel.unban_user(username)
+                else:
+                    await channel.unmute_user(username)
+
+            # One failing does not hold up the rest. If it was not lifted after all, try again next tick.
+            except Exception as error:
+                eprint(f"Error lifting {kind} of {username} in {name}: {error}")
+
+                if (username in channel.settings[kind]):
+                    self.schedule(key, now + self.interval)
+
+                continue
+
+            metrics.expiries.inc(value = "ban" if kind == Ban else "mute")
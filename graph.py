@@ -0,0 +1,105 @@
+import cache
+
+from config import Caching
+
+
+class SocialGraph:
+    # The settings that hold the edges of the graph.
+    edges = ("!blocked", "!friends", "!channels")
+
+    def __init__(self, users):
+        """Who has blocked whom, who is friends with whom and who is in which channel.
+        Each node is a user's edges, copied out of their settings when first looked at and kept
+        up to date by every write of those settings, online or not. Only the users looked at most
+        recently are indexed, so checks between two users are set lookups without a query.
+        """
+
+        self.users = users
+
+        # username -> {edge: frozenset of who or what is at the other end}
+        self.nodes: cache.LRUCache = cache.LRUCache("graph", Caching.GraphSize, Caching.GraphTTL)
+
+        # The users whose edges changed while nodes were being read, one set for every read underway.
+        self.reads: list = []
+
+
+    def changed(self, username: str, settings: dict, keys):
+        "Settings of a user were written. Bring their node up to date if they are indexed."
+
+        if (not any(key in self.edges for key in keys)):
+            return
+
+        self.nodes.update(username, {edge: frozenset(settings[edge]) for edge in self.edges})
+
+        for changed in self.reads:
+            changed.add(username)
+
+    def forget(self, username: str):
+        "Drop the node of a user, whose edges were changed somewhere that could not update it."
+
+        self.nodes.invalidate(username)
+
+
+    async def node(self, username: str) -> dict:
+        "The edges of a user. The user has to exist."
+
+        if ((node := self.nodes.get(username)) != None):
+            return node
+
+        await self.index_many([username])
+
+        if ((node := self.nodes.get(username)) == None):
+            raise KeyError(f"The user {username} does not exist.")
+
+        return node
+
+
+    async def index_many(self, usernames):
+        "Index every user given that is not already, with at most one query."
+
+        missing: list = [username for username in dict.fromkeys(usernames) if username not in self.nodes]
+
+        if (missing == []):
+            return
+
+        changed: set = set()
+        self.reads.append(changed)
+
+        try:
+            settings: dict = await self.users.get_many_user_settings(missing)
+
+        finally:
+            self.reads.remove(changed)
+
+        for username, usersettings in settings.items():
+            node: dict = {edge: frozenset(usersettings[edge]) for edge in self.edges}
+
+            # Their edges changed while the settings were read, which may have been before.
+            if (username in changed):
+                node = {edge: frozenset((await self.users.get_user_settings(username))[edge]) for edge in self.edges}
+
+            self.nodes.put(username, node)
+
+
+    async def has_blocked(self, username: str, other: str) -> bool:
+        "Has username blocked other?"
+
+        return other in (await self.node(username))["!blocked"]
+
+    async def are_friends(self, username1: str, username2: str) -> bool:
+        return username2 in (await self.node(username1))["!friends"]
+
+    async def share_channel(self, username1: str, username2: str) -> bool:
+        "Are two users within mutual channels?"
+
+        # Both at once, should neither be indexed yet.
+        await self.index_many([username1, username2])
+
+        channels1 = (await self.node(username1))["!channels"]
+        channels2 = (await self.node(username2))["!channels"]
+
+        # Look the smaller one up in the larger one.
+        if (len(channels1) > len(channels2)):
+            channels1, channels2 = channels2, channels1
+
+        return not channels1.isdisjoint(channels2)
@@ -0,0 +1,115 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import time
+import passlib
+import passlib.hash
+
+import config
+import metrics
+
+from util import *
+
+
+def hash_password(password: str) -> str:
+    return passlib.hash.argon2.hash(password)
+
+def verify_password(password: str, passhash: str) -> bool:
+    return passlib.hash.argon2.verify(password, passhash)
+
+
+def timed_call(function, *args) -> tuple:
+    "Run in a pool process: note when the work actually started, then do it. [POOL PROCESS]"
+
+    # The monotonic clock is shared between processes, unlike perf_counter().
+    return time.monotonic(), function(*args)
+
+
+class Saturated(Exception):
+    "The hashing pool has too much work queued up already."
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = config.Hashing.Workers, max_pending: int = config.Hashing.MaxPending):
+        """Hashes and verifies passwords in a pool of processes, so argon2 never stalls the event loop.
+        At most max_pending requests may be running or waiting at once; any more raise Saturated.
+        """
+
+        self.max_pending: int = max_pending
+        self.pending: int = 0
+
+        self.workers: int = workers
+        self.executor: concurrent.futures.ProcessPoolExecutor = self.create_executor()
+
+        metrics.hash_pending.track(lambda: self.pending)
+
+
+    def create_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Spawned, since forking a process with a running event loop and threads is asking for trouble.
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers = self.workers,
+            mp_context = multiprocessing.get_context("spawn")
+        )
+
+
+    def replace_executor(self, broken: concurrent.futures.ProcessPoolExecutor):
+        "A pool process died (say, killed for memory), which breaks the whole pool for good: start a new one."
+
+        # Everything that was waiting on the broken pool fails at once; only the first replaces it.
+        if (self.executor is not broken):
+            return
+
+        eprint("A password hashing process died; starting a new pool.")
+
+        broken.shutdown(wait = False, cancel_futures = True)
+        self.executor = self.create_executor()
+
+
+    async def run(self, function, *args) -> tuple:
+        "Run in the pool, replacing it and trying once more if it is broken. Raises Saturated if it breaks again."
+
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(2):
+            executor = self.executor
+
+            try:
+                return await loop.run_in_executor(executor, timed_call, function, *args)
+
+            except concurrent.futures.process.BrokenProcessPool:
+                self.replace_executor(executor)
+
+        raise Saturated("The password hashing pool keeps breaking.")
+
+
+    async def submit(self, function, *args):
+        "Run function(*args) in the pool, or raise Saturated if too much is waiting."
+
+        if (self.pending >= self.max_pending):
+            metrics.hash_rejected.inc()
+            raise Saturated("Too many password hashes are waiting.")
+
+        self.pending += 1
+        submitted: float = time.monotonic()
+
+        try:
+            started, result = await self.run(function, *args)
+
+        finally:
+            self.pending -= 1
+
+        metrics.hash_wait_seconds.observe(started - submitted)
+        metrics.hash_seconds.observe(time.monotonic() - started)
+
+        return result
+
+
+    async def hash(self, password: str) -> str:
+        return await self.submit(hash_password, password)
+
+    async def verify(self, password: str, passhash: str) -> bool:
+        return await self.submit(verify_password, password, passhash)
+
+
+    def close(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
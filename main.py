@@ -1,10 +1,13 @@
 import os
 import sys
+import asyncio
 import threading
+import multiprocessing
 
 from util import *
 
 import config
+import broker
 import delegateserver
 
 
@@ -12,10 +15,39 @@ def debug_thread(instance):
     while True:
         exec(input("python>"))
 
+
+def run_worker(hostip, port, tls, worker: int):
+    "Entry point of a worker process."
+
+    d = delegateserver.DelegateServer(hostip, port, tls, worker = worker)
+    d.start()
+
+
+async def run_broker(hostip, port, tls, workers: int):
+    "Start the broker, then the worker processes that share the listening port."
+
+    b = broker.Broker()
+    server = await b.listen()
+
+    # Spawned rather than forked, since this process is already running an event loop.
+    context = multiprocessing.get_context("spawn")
+
+    for worker in range(workers):
+        context.Process(
+            target = run_worker, 
+            args = (hostip, port, tls, worker), 
+            daemon = True
+        ).start()
+
+    async with server:
+        await server.serve_forever()
+
+
 def main():
     hostip = config.Networking.Host
     port = config.Networking.Port
     tls = False
+    workers = config.Workers.Count
 
     try:
         for i in range(len(sys.argv)):
@@ -28,6 +60,9 @@ def main():
 
                 elif (sys.argv[i] in ["-h", "--host"]):
                     hostip = sys.argv[i + 1]
+
+                elif (sys.argv[i] in ["-w", "--workers"]):
+                    workers = int(sys.argv[i + 1])
                 
                 else:
                     eprint(f"Flag '{sys.argv[i]}' not recognized... exiting...")
@@ -37,15 +72,25 @@ def main():
         eprint("A required argument was not given... exiting....")
         sys.exit(-2)
 
+    except ValueError:
+        eprint("The number of workers must be an integer... exiting....")
+        sys.exit(-3)
+
 
-    status_string = "Delegate Backend Server started on {port} with TLS {tls} on {host}".format(
+    status_string = "Delegate Backend Server started on {port} with TLS {tls} on {host} with {workers} worker(s)".format(
         port = port,
         tls = "enabled" if tls else "disabled",
-        host = hostip
+        host = hostip,
+        workers = workers
     )
 
     print(status_string)
 
+    # Several processes, tied together by the broker.
+    if (workers > 1):
+        asyncio.run(run_broker(hostip, port, tls, workers))
+        return
+
     d = delegateserver.DelegateServer(hostip, port, tls)
 
     threading.Thread(target = debug_thread, args = (d,)).start()
@@ -53,4 +98,4 @@ def main():
     d.start()
 
 if (__name__ == "__main__"):
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,318 @@
+import re
+
+import codec
+import database
+
+
+# The statements the server issues, reduced to their shapes.
+select_statement = re.compile(
+    r"SELECT (?P<columns>.+?) FROM (?P<table>\w+) WHERE (?P<column>\w+) = (?P<any>ANY\()?%s\)?( FOR UPDATE)?;?$", re.I
+)
+insert_statement = re.compile(
+    r"INSERT INTO (?P<table>\w+) \((?P<columns>[^)]*)\) VALUES \([^)]*\)"
+    r"(?P<conflict> ON CONFLICT DO NOTHING)?( RETURNING (?P<returning>\w+))?;?$", re.I
+)
+insert_many_statement = re.compile(
+    r"INSERT INTO (?P<table>\w+) \((?P<columns>[^)]*)\) SELECT \* FROM UNNEST\((%s::\w+\[\](, )?)+\);?$", re.I
+)
+update_statement = re.compile(r"UPDATE (?P<table>\w+) SET (?P<assignments>.+?) WHERE (?P<column>\w+) = %s;?$", re.I)
+delete_statement = re.compile(r"DELETE FROM (?P<table>\w+) WHERE (?P<column>\w+) = %s;?$", re.I)
+
+# JSON objects merged into objects inside of a JSON column, for one row or for many rows
+# at once from parallel arrays, as in
+# UPDATE t SET c = jsonb_set(c, '{p}', (c->'p') || %s::jsonb) WHERE k = %s RETURNING (c->'p')::text;
+# UPDATE t SET c = jsonb_set(jsonb_set(c, '{p}', (c->'p') || batch.v::jsonb), '{q,r}', (c->'q'->'r') || batch.w::jsonb)
+#     FROM (SELECT UNNEST(%s::text[]) AS k, UNNEST(%s::text[]) AS v, UNNEST(%s::text[]) AS w) AS batch WHERE t.k = batch.k;
+# The objects are given in the order their paths appear.
+patch_statement = re.compile(
+    r"UPDATE (?P<table>\w+) SET (?P<column>\w+) = (?P<patches>jsonb_set\(.+\))"
+    r"(?P<batch> FROM \(SELECT (UNNEST\(%s::\w+\[\]\) AS \w+(, )?)+\) AS batch)?"
+    r" WHERE (\w+\.)?(?P<key>\w+) = (%s|batch\.\w+)(?P<returning> RETURNING .+?)?;?$", re.I
+)
+patch_path = re.compile(r"'\{(?P<path>[\w,]+)\}'")
+
+# A value removed from inside of a JSON column, as in UPDATE t SET c = c #- ARRAY['p', %s] WHERE k = %s;
+remove_path_statement = re.compile(
+    r"UPDATE (?P<table>\w+) SET (?P<column>\w+) = \w+ #- ARRAY\[(?P<path>[^\]]*)\] WHERE (?P<key>\w+) = %s;?$", re.I
+)
+
+# One value from inside of a JSON column, as in SELECT (c->'p'->%s)::text FROM t WHERE k = %s;
+select_path_statement = re.compile(
+    r"SELECT \((?P<column>\w+)->'(?P<path>\w+)'->%s\)::text FROM (?P<table>\w+) WHERE (?P<key>\w+) = %s( FOR UPDATE)?;?$", re.I
+)
+
+# Schema changes mean nothing here.
+ignored_statement = re.compile(r"(CREATE|ALTER|DROP) ", re.I)
+
+
+def split_columns(columns: str) -> list:
+    "The column names, without any casts."
+
+    return [column.strip().split("::")[0].lower() for column in columns.split(",")]
+
+
+class MemoryTable:
+    def __init__(self, key: str = None):
+        "Rows are dictionaries, indexed by their key column if the table has one."
+
+        self.key: str = key
+        self.rows: dict = {}
+        self.log: list = []
+
+    def find(self, column: str, value) -> list:
+        if (column == self.key):
+            row = self.rows.get(value)
+            return [] if row == None else [row]
+
+        return [row for row in self.all() if row.get(column) == value]
+
+    def all(self) -> list:
+        return list(self.rows.values()) if self.key != None else self.log
+
+    def insert(self, row: dict):
+        if (self.key != None):
+            self.rows[row[self.key]] = row
+        else:
+            self.log.append(row)
+
+    def delete(self, column: str, value):
+        for row in self.find(column, value):
+            if (self.key != None):
+                del self.rows[row[self.key]]
+            else:
+                self.log.remove(row)
+
+
+class MemoryCursor:
+    def __init__(self, db):
+        "A cursor over a MemoryDatabase, with just what the server uses of a psycopg2 cursor."
+
+        self.db = db
+        self.results: list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query: str, args: tuple = None):
+        self.results = self.db.query(query, () if args == None else tuple(args))
+
+    def fetchone(self) -> tuple:
+        return self.results[0] if self.results != [] else None
+
+    def fetchall(self) -> list:
+        return self.results
+
+
+class MemoryDatabase(database.Database):
+    """An in-memory stand-in for the database, for benchmarks.
+    It understands just enough SQL for the statements that the server issues.
+    """
+
+    # Tables whose rows are looked up by one column.
+    keys = {
+        "users": "username",
+        "channels": "channel"
+    }
+
+    def __init__(self):
+        self.size: int = 1
+        self.tables: dict = {}
+
+        # Parsed statements, by their text.
+        self.statements: dict = {}
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def run(self, function, *args):
+        "Run function(cursor, *args) right away. Every statement is instant, so there is nothing to wait for."
+
+        return function(MemoryCursor(self), *args)
+
+
+    def table(self, name: str) -> MemoryTable:
+        name = name.lower()
+
+        if (name not in self.tables):
+            self.tables[name] = MemoryTable(self.keys.get(name))
+
+        return self.tables[name]
+
+
+    def parse(self, query: str):
+        "Reduce a statement to a function(args) that carries it out."
+
+        query = " ".join(query.split())
+
+        if (ignored_statement.match(query)):
+            return lambda args: []
+
+        # JSON columns are kept as text, and decoded whenever they are looked into.
+        if ((match := patch_statement.match(query)) != None):
+            table = self.table(match["table"])
+            column = match["column"].lower()
+            paths = [path.split(",") for path in patch_path.findall(match["patches"])]
+            key = match["key"].lower()
+            batch = match["batch"] != None
+            returning = match["returning"] != None
+
+            def patch(args):
+                # (key value, object for each path)
+                rows = zip(*args) if batch else [(args[-1], *args[:-1])]
+                results = []
+
+                for value, *changes in rows:
+                    for row in table.find(key, value):
+                        document = codec.decode(row[column])
+
+                        for path, change in zip(paths, changes):
+                            target = document
+
+                            for step in path:
+                                target = target[step]
+
+                            target.update(codec.decode(change))
+
+                        row[column] = codec.encode_text(document)
+                        results.append((codec.encode_text(document[paths[0][0]]),))
+
+                return results if returning else []
+
+            return patch
+
+        if ((match := remove_path_statement.match(query)) != None):
+            table = self.table(match["table"])
+            column = match["column"].lower()
+            path = [step.strip() for step in match["path"].split(",")]
+            key = match["key"].lower()
+
+            def remove(args):
+                # Quoted steps are literal, the others are arguments.
+                steps = []
+                index = 0
+
+                for step in path:
+                    if (step == "%s"):
+                        steps.append(args[index])
+                        index += 1
+                    else:
+                        steps.append(step.strip("'"))
+
+                for row in table.find(key, args[index]):
+                    document = codec.decode(row[column])
+                    target = document
+
+                    for step in steps[:-1]:
+                        target = target[step]
+
+                    target.pop(steps[-1], None)
+                    row[column] = codec.encode_text(document)
+
+                return []
+
+            return remove
+
+        if ((match := select_path_statement.match(query)) != None):
+            table = self.table(match["table"])
+            column = match["column"].lower()
+            path = match["path"]
+            key = match["key"].lower()
+
+            # A key that is not there is NULL, as opposed to a JSON null.
+            def select_path(args):
+                results = []
+
+                for row in table.find(key, args[1]):
+                    inner: dict = codec.decode(row[column])[path]
+                    results.append((codec.encode_text(inner[args[0]]) if args[0] in inner else None,))
+
+                return results
+
+            return select_path
+
+        if ((match := select_statement.match(query)) != None):
+            table = self.table(match["table"])
+            columns = split_columns(match["columns"])
+            column = match["column"].lower()
+
+            # = ANY(%s) matches any value of a list.
+            if (match["any"] != None):
+                return lambda args: [
+                    tuple(row.get(c) for c in columns) for value in args[0] for row in table.find(column, value)
+                ]
+
+            return lambda args: [
+                tuple(row.get(c) for c in columns) for row in table.find(column, args[0])
+            ]
+
+        if ((match := insert_statement.match(query)) != None):
+            table = self.table(match["table"])
+            columns = split_columns(match["columns"])
+
+            conflict = match["conflict"] != None
+            returning = None if match["returning"] == None else match["returning"].lower()
+
+            # ON CONFLICT DO NOTHING skips a row whose key is taken, and RETURNING only has the inserted rows.
+            def insert(args):
+                row = dict(zip(columns, args))
+
+                if (conflict and table.key != None and row[table.key] in table.rows):
+                    return []
+
+                table.insert(row)
+                return [] if returning == None else [(row[returning],)]
+
+            return insert
+
+        # Many rows at once, from parallel arrays.
+        if ((match := insert_many_statement.match(query)) != None):
+            table = self.table(match["table"])
+            columns = split_columns(match["columns"])
+
+            def insert_many(args):
+                for row in zip(*args):
+                    table.insert(dict(zip(columns, row)))
+
+                return []
+
+            return insert_many
+
+        if ((match := update_statement.match(query)) != None):
+            table = self.table(match["table"])
+            assigned = [assignment.split("=")[0].strip().lower() for assignment in match["assignments"].split(",")]
+            column = match["column"].lower()
+
+            def update(args):
+                for row in table.find(column, args[-1]):
+                    row.update(zip(assigned, args))
+
+                return []
+
+            return update
+
+        if ((match := delete_statement.match(query)) != None):
+            table = self.table(match["table"])
+            column = match["column"].lower()
+
+            def delete(args):
+                table.delete(column, args[0])
+                return []
+
+            return delete
+
+        raise NotImplementedError(f"The memory database does not understand: {query}")
+
+
+    def query(self, query: str, args: tuple) -> list:
+        "Carry out a statement, returning the rows it produced."
+
+        if ((statement := self.statements.get(query)) == None):
+            statement = self.statements[query] = self.parse(query)
+
+        return statement(args)
@@ -1,8 +1,12 @@
-import json
+import codec
 import uuid
 import time
-import psycopg2
 import hashlib
+import database
+import metrics
+import writebehind
+
+from config import *
 
 class MessageOrigins:
     "An enumeration describing different message origins."
@@ -62,7 +66,7 @@ class Message:
         return result
 
     def __str__(self):
-        return json.dumps(self.to_dict())
+        return codec.encode_text(self.to_dict())
 
 
 
@@ -70,20 +74,50 @@ queryables = [
     
 ]
 
+class ChannelMessageWriter(writebehind.WriteBehind):
+    def __init__(self, instance, interval: float = ChannelMessageWrites.Interval, batch_size: int = ChannelMessageWrites.BatchSize):
+        """Stores channel messages in batches, by their uuid, so that sending one never waits on the database.
+        A batch is a single INSERT of parallel arrays.
+        """
+
+        super().__init__("channel message", interval, batch_size, metrics.messagedb_flush_seconds, metrics.messagedb_flush_size)
+
+        self.instance = instance
+        metrics.messagedb_queue_depth.track(lambda: len(self.dirty))
+
+
+    async def write(self, batch: list):
+        await MessagesDatabase.channel_messages_many(self.instance, batch)
+
+
 class MessagesDatabase:
     "A class which handles inputting messages into a database."
 
     def __init__(self, instance):
         self.instance = instance
-        self.database = instance.database
-        self.cursor: psycopg2.cursor = instance.cursor
+        self.database: database.Database = instance.db
+
+        # Channel messages are stored behind the back of whoever sent them.
+        self.writer: ChannelMessageWriter = ChannelMessageWriter(instance)
+
 
+    def start(self):
+        "Start storing queued messages. Must be called from within the running event loop."
 
+        self.writer.start()
 
-    def user_message(self, msg: Message):
+    async def stop(self):
+        "Store every message still waiting. Called on shutdown."
+
+        await self.writer.stop()
+
+
+
+    @metrics.timed(metrics.sql_seconds)
+    async def user_message(self, msg: Message):
         "Store a user private message into the database."
 
-        self.cursor.execute((
+        await self.database.execute((
             "INSERT INTO UserMessages (id, kind, parties, whom, containing, creation, format)"
             " VALUES (%s, %s, %s, %s, %s, %s, %s);"
         ), (
@@ -96,9 +130,29 @@ class MessagesDatabase:
             msg.format
         ))
 
-        self.database.commit()
-
     
 
-    def channel_message(self, event: dict):
-        pass
\ No newline at end of file
+    async def channel_message(self, msg: Message):
+        "Queue a channel message to be stored. It is written with the next batch."
+
+        self.writer.mark(msg.uuid, msg)
+
+    @staticmethod
+    @metrics.timed(metrics.sql_seconds)
+    async def channel_messages_many(instance, batch: list):
+        "Store many channel messages with one statement."
+
+        await instance.db.execute((
+            "INSERT INTO ChannelMessages (id, kind, channel, subchannel, whom, containing, creation, format)"
+            " SELECT * FROM UNNEST(%s::uuid[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[],"
+            " %s::integer[], %s::text[]);"
+        ), (
+            [msg.uuid for msg in batch],
+            [msg.kind for msg in batch],
+            [msg.channel for msg in batch],
+            [msg.subchannel for msg in batch],
+            [msg.username for msg in batch],
+            [msg.contents for msg in batch],
+            [msg.created for msg in batch],
+            [msg.format for msg in batch]
+        ))
@@ -0,0 +1,338 @@
+import asyncio
+import bisect
+import functools
+import time
+
+import config
+
+
+# Everything here is a no-op unless metrics are turned on, so that instrumenting
+# a hot path costs next to nothing when nobody is scraping.
+enabled: bool = config.Metrics.Enabled
+
+# Every metric, in the order they are exposed.
+registry: list = []
+
+# Seconds, from 100 microseconds to 10 seconds.
+latency_buckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Recipients, from one to a very large channel.
+size_buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def now() -> float:
+    "The time to pass to observe_since() later. Returns 0 when metrics are off."
+
+    return time.perf_counter() if enabled else 0.0
+
+
+def format_labels(label: str, value: str, extra: str = None) -> str:
+    labels = []
+
+    if (label != None):
+        labels.append(f'{label}="{value}"')
+
+    if (extra != None):
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels != [] else ""
+
+
+def format_number(value: float) -> str:
+    if (value == float("inf")):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        "A number that only goes up, optionally split by one label."
+
+        self.name: str = name
+        self.help: str = help
+        self.label: str = label
+        self.values: dict = {}
+
+        registry.append(self)
+
+    def inc(self, amount: float = 1, value: str = None):
+        if (not enabled):
+            return
+
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+
+        for value, total in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.label, value)} {format_number(total)}")
+
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        "A number that is read when scraped, from a function given to track()."
+
+        self.name: str = name
+        self.help: str = help
+        self.function = None
+
+        registry.append(self)
+
+    def track(self, function):
+        "Read the gauge from function() on every scrape."
+
+        self.function = function
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+
+        if (self.function != None):
+            lines.append(f"{self.name} {format_number(self.function())}")
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str = None, buckets: tuple = latency_buckets):
+        "Counts observations into buckets, optionally split by one label."
+
+        self.name: str = name
+        self.help: str = help
+        self.label: str = label
+        self.buckets: tuple = buckets
+
+        # label value -> [per bucket counts (not cumulative), sum, count]
+        self.values: dict = {}
+
+        registry.append(self)
+
+    def observe(self, amount: float, value: str = None):
+        if (not enabled):
+            return
+
+        if ((entry := self.values.get(value)) == None):
+            entry = self.values[value] = [[0] * (len(self.buckets) + 1), 0, 0]
+
+        entry[0][bisect.bisect_left(self.buckets, amount)] += 1
+        entry[1] += amount
+        entry[2] += 1
+
+    def observe_since(self, started: float, value: str = None):
+        "Observe the seconds since started, which came from now()."
+
+        if (not enabled):
+            return
+
+        self.observe(time.perf_counter() - started, value)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for value, (counts, total, count) in self.values.items():
+            cumulative = 0
+
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = f'le="{format_number(bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label, value, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.label, value)} {format_number(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label, value)} {count}")
+
+        return lines
+
+
+def timed(histogram: Histogram):
+    "Decorate a coroutine function so that its duration is observed, labelled by its qualified name."
+
+    def decorator(function):
+        # Leave the function untouched when metrics are off, so it costs nothing at all.
+        if (not enabled):
+            return function
+
+        name: str = function.__qualname__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                return await function(*args, **kwargs)
+
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    "Every metric in the Prometheus text exposition format."
+
+    lines = []
+
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    "A minimal HTTP/1.0 responder: GET /metrics and nothing else."
+
+    try:
+        request: bytes = await reader.readline()
+
+        # The headers are not needed, but they have to be read.
+        while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+            pass
+
+        parts = request.decode(errors = "replace").split()
+
+        if (len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics"):
+            status = "200 OK"
+            body = render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+
+        writer.write((
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode() + body)
+
+        await writer.drain()
+
+    except ConnectionError:
+        pass
+
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    "Start serving the metrics endpoint."
+
+    return await asyncio.start_server(handle_scrape, host, port)
+
+
+
+# The metrics of the server
+
+command_seconds = Histogram(
+    "delegate_command_seconds", "Time spent handling a command.", label = "command"
+)
+
+sql_seconds = Histogram(
+    "delegate_sql_seconds", "Time spent in a database method, including waiting for a pooled connection.", label = "method"
+)
+
+userdb_flush_seconds = Histogram(
+    "delegate_userdb_flush_seconds", "Time taken to write one batch of queued user state to the database."
+)
+
+userdb_flush_size = Histogram(
+    "delegate_userdb_flush_users", "Users written to the database by one batched statement.", buckets = size_buckets
+)
+
+userdb_queue_depth = Gauge(
+    "delegate_userdb_queue_depth", "Users waiting for their state to be written to the database."
+)
+
+presence_changes = Counter(
+    "delegate_presence_changes_total", "Status changes made by the presence engine.", label = "status"
+)
+
+cache_hits = Counter(
+    "delegate_cache_hits_total", "Lookups answered by a cache.", label = "cache"
+)
+
+cache_misses = Counter(
+    "delegate_cache_misses_total", "Lookups a cache could not answer, including expired entries.", label = "cache"
+)
+
+cache_evictions = Counter(
+    "delegate_cache_evictions_total", "Entries a full cache dropped to make room.", label = "cache"
+)
+
+channeldb_flush_seconds = Histogram(
+    "delegate_channeldb_flush_seconds", "Time taken to write one batch of queued channel state to the database."
+)
+
+channeldb_flush_size = Histogram(
+    "delegate_channeldb_flush_channels", "Channels written to the database by one batch.", buckets = size_buckets
+)
+
+channeldb_queue_depth = Gauge(
+    "delegate_channeldb_queue_depth", "Channels waiting for their state to be written to the database."
+)
+
+loaded_channels = Gauge(
+    "delegate_loaded_channels", "Channels held in memory."
+)
+
+channels_evicted = Counter(
+    "delegate_channels_evicted_total", "Channels unloaded for being idle without online members."
+)
+
+channel_messages = Counter(
+    "delegate_channel_messages_total", "Messages sent to channels."
+)
+
+messagedb_flush_seconds = Histogram(
+    "delegate_messagedb_flush_seconds", "Time taken to store one batch of queued channel messages."
+)
+
+messagedb_flush_size = Histogram(
+    "delegate_messagedb_flush_messages", "Channel messages stored by one batched statement.", buckets = size_buckets
+)
+
+messagedb_queue_depth = Gauge(
+    "delegate_messagedb_queue_depth", "Channel messages waiting to be stored."
+)
+
+expiries = Counter(
+    "delegate_expiries_total", "Channel bans and mutes lifted because they ran out.", label = "kind"
+)
+
+online_users = Gauge(
+    "delegate_online_users", "Users with at least one connection."
+)
+
+sockets = Gauge(
+    "delegate_sockets", "Open websocket connections, signed in or not."
+)
+
+connections = Gauge(
+    "delegate_connections", "Signed in connections, including event connections."
+)
+
+signins = Counter(
+    "delegate_signins_total", "Successful sign-ins, by whether a password or a resume token was used.", label = "method"
+)
+
+hash_wait_seconds = Histogram(
+    "delegate_hash_wait_seconds", "Time a password hash or verification waited for a pool process."
+)
+
+hash_seconds = Histogram(
+    "delegate_hash_seconds", "Time a pool process spent on a password hash or verification."
+)
+
+hash_pending = Gauge(
+    "delegate_hash_pending", "Password hashes and verifications running or waiting."
+)
+
+hash_rejected = Counter(
+    "delegate_hash_rejected_total", "Sign-ins and registrations turned away because the hashing pool was saturated."
+)
+
+fanout_size = Histogram(
+    "delegate_fanout_sockets", "Event connections reached by one broadcast.", buckets = size_buckets
+)
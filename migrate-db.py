@@ -0,0 +1,91 @@
+import psycopg2
+import blessed
+import sys
+import config
+
+t = blessed.Terminal()
+
+def main():
+    database = psycopg2.connect(
+        host = config.Database.Host,
+        dbname = config.Database.Name, 
+        user = config.Database.Username, 
+        password = config.Database.Password
+    )
+
+    cursor = database.cursor()
+
+    # The columns holding JSON state, and what each is stored as right now.
+    columns = {}
+
+    for table, column in [("users", "settings"), ("channels", "state")]:
+        cursor.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s;",
+            (table, column)
+        )
+
+        row = cursor.fetchone()
+
+        # There is no such table yet: the server will create it as it should be.
+        if (row != None and row[0] != "jsonb"):
+            columns[(table, column)] = row[0]
+
+    # The tables keyed by a name that has no primary key yet.
+    keys = []
+
+    for table, column in [("users", "username"), ("channels", "channel")]:
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = %s;",
+            (table,)
+        )
+
+        if (cursor.fetchone()[0] == 0):
+            continue
+
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.table_constraints WHERE table_name = %s AND constraint_type = 'PRIMARY KEY';",
+            (table,)
+        )
+
+        if (cursor.fetchone()[0] == 0):
+            keys.append((table, column))
+
+    if (columns == {} and keys == []):
+        print("All state is already stored as JSONB and every name is unique. Nothing to do.")
+        sys.exit(0)
+
+    for (table, column), data_type in columns.items():
+        print(t.yellow_bold(f"{table}.{column} is stored as {data_type} and will be converted to JSONB."))
+
+    for table, column in keys:
+        cursor.execute(f"SELECT {column} FROM {table} GROUP BY {column} HAVING COUNT(*) > 1;")
+        duplicates = [row[0] for row in cursor.fetchall()]
+
+        # These have to be sorted out by hand, there is no telling which row is the real one.
+        if (duplicates != []):
+            print(t.red_bold(f"{table}.{column} cannot be made unique, these are registered more than once: {', '.join(duplicates)}"))
+            print("Exiting with code -1...")
+            sys.exit(-1)
+
+        print(t.yellow_bold(f"{table}.{column} will become the primary key of {table}."))
+
+    # Verify if they want to continue
+    if (input("Do you wish to continue (Y/y/N/n)?: ") not in ["y", "Y"]):
+        print("Exiting with code -1...")
+        sys.exit(-1)
+
+    # Every row is parsed as it is converted; a row that is not valid JSON aborts the whole thing.
+    for table, column in columns:
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB USING {column}::jsonb;")
+
+    # Two registrations racing for the same name can no longer both succeed.
+    for table, column in keys:
+        cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY ({column});")
+
+    database.commit()
+
+    print("Done! Single settings can now be written on their own, and every name is unique.")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,65 @@
+class OrderedSet:
+    def __init__(self, values = ()):
+        """A set that remembers the order values were added in.
+        Membership, adding and removing are O(1), unlike with a list. It is backed by
+        a dictionary, whose keys keep their insertion order.
+        The codec encodes it as a list, so it is stored and sent exactly like one.
+        """
+
+        self.values: dict = dict.fromkeys(values)
+
+    def __contains__(self, value) -> bool:
+        return value in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __eq__(self, other) -> bool:
+        if (isinstance(other, OrderedSet)):
+            return self.values.keys() == other.values.keys()
+
+        # Compares equal to a list with the same values in the same order.
+        if (isinstance(other, list)):
+            return list(self.values) == other
+
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"OrderedSet({list(self.values)!r})"
+
+
+    def add(self, value):
+        self.values[value] = None
+
+    # So code written for lists keeps working.
+    append = add
+
+    def discard(self, value):
+        self.values.pop(value, None)
+
+    def remove(self, value):
+        "Remove a value, raising ValueError if it is not there, as a list would."
+
+        if (value not in self.values):
+            raise ValueError(f"{value!r} is not in the set.")
+
+        del self.values[value]
+
+
+    def union(self, *others) -> "OrderedSet":
+        "Every value of this and the others, in the order they first appear."
+
+        result = OrderedSet(self.values)
+
+        for other in others:
+            result.values.update(dict.fromkeys(other))
+
+        return result
+
+    __or__ = union
+
+    def copy(self) -> "OrderedSet":
+        return OrderedSet(self.values)
@@ -0,0 +1,92 @@
+import time
+
+import config
+import deadlines
+import metrics
+
+from definitions import *
+from util import *
+
+
+class PresenceEngine(deadlines.DeadlineScheduler):
+    def __init__(self, users,
+                 away: float = config.UserSettings.UserAwayTime,
+                 offline: float = config.UserSettings.UserOfflineTime,
+                 interval: float = config.Presence.Interval):
+        """Moves idle users from Online to Away, and then to Offline, without ever scanning everyone.
+        Every watched user has one deadline, by username: the moment they would next change status if
+        they did nothing more. Activity only records a timestamp, and a deadline that comes up too
+        early is pushed back to where the activity moved it, so activity is O(1) and deadlines O(log n).
+        """
+
+        super().__init__("updating presence", interval)
+
+        self.users = users
+        self.away: float = away
+        self.offline: float = offline
+
+
+    def watch(self, user):
+        "Start watching a user who just came online."
+
+        self.schedule(user.username, user.last_meaningful_action + self.away)
+
+
+    async def touch(self, user):
+        "The user did something meaningful. Brings them back Online if they were idle."
+
+        user.last_meaningful_action = time.time()
+
+        if (user.settings["$status"] == UserStatuses.Online):
+            return
+
+        self.schedule(user.username, user.last_meaningful_action + self.away)
+
+        await self.users.change_user_settings(user.username, {
+            "$status": UserStatuses.Online
+        }, special = True)
+
+        metrics.presence_changes.inc(value = "online")
+
+
+    async def tick(self):
+        "Apply every deadline that has passed, then announce the status changes together."
+
+        now: float = time.time()
+        changes: dict = {}
+
+        for username in self.due(now):
+            if ((user := self.users.users.get(username)) == None):
+                self.forget(username)
+                continue
+
+            status: int = changes.get(username, user.settings["$status"])
+            idle: float = now - user.last_meaningful_action
+
+            if (status == UserStatuses.Online):
+                # Active since this deadline was set: it moves back.
+                if (idle < self.away):
+                    self.schedule(username, user.last_meaningful_action + self.away)
+                    continue
+
+                changes[username] = UserStatuses.Away
+                self.schedule(username, user.last_meaningful_action + self.offline)
+
+            elif (status == UserStatuses.Away):
+                if (idle < self.offline):
+                    self.schedule(username, user.last_meaningful_action + self.offline)
+                    continue
+
+                # Nothing more can happen to them until they do something again.
+                changes[username] = UserStatuses.Offline
+                self.forget(username)
+
+            else:
+                self.forget(username)
+
+        for username, status in changes.items():
+            await self.users.change_user_settings(username, {
+                "$status": status
+            }, special = True)
+
+            metrics.presence_changes.inc(value = "away" if status == UserStatuses.Away else "offline")
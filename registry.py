@@ -0,0 +1,83 @@
+import itertools
+import time
+
+import metrics
+
+
+class ConnectionRegistry:
+    def __init__(self):
+        """Every open connection of this server, by a stable id and by remote address.
+        Adding and removing a connection are O(1), so sockets can come and go freely,
+        and admin tooling can list or kill connections without touching the users.
+        """
+
+        self.counter = itertools.count(1)
+
+        # id -> Connection
+        self.by_id: dict = {}
+
+        # remote host -> {id -> Connection}
+        self.by_address: dict = {}
+
+        metrics.sockets.track(lambda: len(self.by_id))
+
+
+    def register(self, connection) -> int:
+        "Give a new connection its id and index it."
+
+        connection.id = next(self.counter)
+        connection.opened = time.time()
+
+        self.by_id[connection.id] = connection
+        self.by_address.setdefault(connection.host, {})[connection.id] = connection
+
+        return connection.id
+
+
+    def unregister(self, connection):
+        "Forget a closed connection. Does nothing if it was already forgotten."
+
+        if (self.by_id.pop(connection.id, None) == None):
+            return
+
+        same_host: dict = self.by_address[connection.host]
+        del same_host[connection.id]
+
+        if (same_host == {}):
+            del self.by_address[connection.host]
+
+
+    def get(self, id: int):
+        "The connection with an id, or None."
+
+        return self.by_id.get(id)
+
+    def from_address(self, host: str) -> list:
+        "Every connection from a remote host."
+
+        return list(self.by_address.get(host, {}).values())
+
+
+    def describe(self) -> list:
+        "What admin tooling shows about every connection."
+
+        return [{
+            "id": connection.id,
+            "address": connection.host,
+            "username": connection.username,
+            "event": connection.event,
+            "opened": round(connection.opened),
+            "outbound": connection.stats()
+        } for connection in self.by_id.values()]
+
+
+    async def kill(self, id: int) -> bool:
+        """Close a connection. Its handler then logs it off as with any other closed socket.
+        Returns whether there was such a connection.
+        """
+
+        if ((connection := self.by_id.get(id)) == None):
+            return False
+
+        await connection.close()
+        return True
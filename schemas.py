@@ -0,0 +1,69 @@
+from definitions import *
+
+
+# Stands in for a field that was not sent at all, since None means it was sent as null.
+MISSING = object()
+
+
+class Field:
+    def __init__(self, *kinds: type, required: bool = True, nullable: bool = False, of: tuple = None):
+        """Describes one field of a command body: which JSON types it may have,
+        whether it has to be sent and whether it may be null.
+        of is the type, or tuple of types, that every element of a list (or value of an object) must have.
+        """
+
+        self.kinds: tuple = kinds
+        self.required: bool = required
+        self.nullable: bool = nullable
+        self.of: frozenset = None if of == None else frozenset(of if isinstance(of, tuple) else (of,))
+
+    def types(self) -> frozenset:
+        "Every exact type that is accepted."
+
+        # JSON only ever decodes into these exact types, so there is no need for
+        # isinstance(), which would also let booleans pass as integers.
+        if (self.nullable):
+            return frozenset(self.kinds + (NoneType,))
+
+        return frozenset(self.kinds)
+
+
+def compile_schema(schema: dict):
+    """Compile a schema (field name -> Field) into a validator.
+    The validator takes a command body and returns the error code to send back, or None if it is valid.
+    """
+
+    fields: tuple = tuple(
+        (name, field.types(), field.required, field.of) for name, field in schema.items()
+    )
+
+    def validator(body: dict) -> int:
+        for name, types, required, of in fields:
+            value = body.get(name, MISSING)
+
+            if (value is MISSING):
+                if (required):
+                    return CommandCodes.ArgsMissing
+
+                continue
+
+            if (type(value) not in types):
+                return CommandCodes.InvalidTypes
+
+            if (of != None and type(value) in [list, dict]):
+                elements = value.values() if type(value) == dict else value
+
+                if (any(type(element) not in of for element in elements)):
+                    return CommandCodes.InvalidTypes
+
+        return None
+
+    return validator
+
+
+def compile_schemas(schemas: dict, common: dict = {}) -> dict:
+    """Compile a dictionary of command name -> schema into command name -> validator.
+    The fields in common are added to every schema.
+    """
+
+    return {name: compile_schema({**common, **schema}) for name, schema in schemas.items()}
@@ -0,0 +1,61 @@
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+import config
+
+
+# Spawned workers inherit the environment, which is how they end up with the same secret as the main process.
+secret_variable = "DELEGATE_TOKEN_SECRET"
+
+
+def load_secret() -> bytes:
+    "The configured secret, or the one this server started with, making it first if need be."
+
+    if (config.Tokens.Secret != None):
+        return config.Tokens.Secret.encode()
+
+    if ((secret := os.environ.get(secret_variable)) == None):
+        secret = os.environ[secret_variable] = secrets.token_hex(32)
+
+    return secret.encode()
+
+
+secret: bytes = load_secret()
+
+
+def sign(payload: str) -> str:
+    return hmac.new(secret, payload.encode(), hashlib.sha256).hexdigest()
+
+
+def issue(username: str, generation: int, lifetime: int = config.Tokens.Lifetime) -> str:
+    """Issue a resume token, which signs the user in without their password until it expires,
+    or until their token generation moves past the one given, which revokes it.
+    Looks like username:generation:expiry:signature
+    """
+
+    payload: str = f"{username}:{generation}:{round(time.time()) + lifetime}"
+    return f"{payload}:{sign(payload)}"
+
+
+def verify(token: str) -> tuple:
+    """The (username, generation) a token was issued for, or None if it is forged, malformed or expired.
+    Whether the generation is still the user's is up to the caller.
+    """
+
+    parts: list = token.rsplit(":", 3)
+
+    if (len(parts) != 4):
+        return None
+
+    username, generation, expiry, signature = parts
+
+    if (not hmac.compare_digest(sign(f"{username}:{generation}:{expiry}"), signature)):
+        return None
+
+    if (not expiry.isdigit() or int(expiry) < time.time() or not generation.isdigit()):
+        return None
+
+    return username, int(generation)
@@ -4,28 +4,29 @@ from platform import python_version_tuple
 from typing import Any
 
 import asyncio
+import writebehind
 import uuid
 import time
-import json
-import passlib
-import passlib.hash
-import psycopg2
+import cache
+import codec
+import graph
+import presence
 import messages
-import queue
-import threading
 import pyotp
+import database
+import metrics
 
 from settings import *
+from orderedset import OrderedSet
 from config import UserSettingRegulations
 from config import UserSettings
 from config import UserRegulations
+from config import UserStateWrites
+from config import Caching
+from config import Events
 
 from definitions import *
-
-class UserStatuses:
-    Online = 0
-    Away = 1
-    Offline = 2
+from util import *
 
 # Store setting regulations within an easily accessible dictionary
 setting_infos = {
@@ -65,6 +66,7 @@ def generate_user_state(creation: int, bot: bool) -> dict:
             "!subscriptionstome": [],
             "!privatedsettings": [],
             "!privatewhitelist": {},
+            "!tokengen": 0,
             "$bot": bot,
             "perms": [],
             "&invisible": True,
@@ -83,65 +85,110 @@ def generate_user_state(creation: int, bot: bool) -> dict:
     return default_state
 
 
-def user_database_queue(q: queue.Queue):
-    "Handle users that need their state written to the database"
+# Settings that hold relationships. In memory they are OrderedSets, so that
+# looking someone up in them does not scan a list.
+relation_settings = (
+    "!channels",
+    "!gchannels",
+    "!blocked",
+    "!friends",
+    "!friendreqs",
+    "!subscriptionsto",
+    "!subscriptionstome",
+    "!privatedsettings"
+)
+
+
+def load_relations(settings: dict) -> dict:
+    "Turn the relationship lists of freshly decoded settings into OrderedSets, in place."
+
+    for key in relation_settings:
+        if (key in settings):
+            settings[key] = OrderedSet(settings[key])
+
+    return settings
+
+
+def form_event(name: str, body: dict) -> str:
+    "Encode an event into the frame that is sent over the wire."
+
+    result = {
+        "event": name,
+    }
+
+    result.update(body)
+    return codec.encode_text(result)
+
+
+class UserStateWriter(writebehind.WriteBehind):
+    def __init__(self, instance, interval: float = UserStateWrites.Interval, batch_size: int = UserStateWrites.BatchSize):
+        """Writes the state of changed users to the database, by username.
+        Only the settings that changed are sent, and each batch is written with a single statement.
+        """
+
+        super().__init__("user", interval, batch_size, metrics.userdb_flush_seconds, metrics.userdb_flush_size)
+
+        self.instance = instance
+        metrics.userdb_queue_depth.track(lambda: len(self.dirty))
+
 
-    while (user := q.get()) != None:
-        u: User = user
-        u.queued = False
+    async def write(self, batch: list):
+        # Encoded now, so that the latest values are what gets written.
+        changed: list = []
+        patches: list = []
 
-        # Store the state into the database
-        u.udb.setsettings(u.get_state())
+        for user in batch:
+            changed.append(user.changed)
+            patches.append(codec.encode_text({key: user.settings[key] for key in user.changed}))
+            user.changed = set()
 
-        # Wait 
-        time.sleep(.5)
+        try:
+            await UserDb.patch_settings_many(self.instance, [user.username for user in batch], patches)
+
+        except Exception:
+            # Along with whatever changed in the meantime.
+            for user, keys in zip(batch, changed):
+                user.changed.update(keys)
+
+            raise
 
 
 
 class User:
-    def __init__(self, username, connection, instance, users):
+    def __init__(self, username, connection, instance, users, event = False):
         self.instance = instance
         self.username: str = username
         self.connection = connection
         self.users: Users = users
         self.udb: UserDb = UserDb(self.instance, self.username)
 
-        # Whether or not to continually add to the database queue.
-        self.queued: bool = False
+        # Setting keys changed since the state was last written.
+        self.changed: set = set()
 
-        # Here is a list of active connections
-        self.connections: list = [
-            connection
-        ]
+        # Held by commands that change this user's state, so they stay in order.
+        self.lock: asyncio.Lock = asyncio.Lock()
 
-        # Here is a list of active connections for live event receiving.
-        self.event_connections = [
+        # Active connections, by connection id
+        self.connections: dict = {
 
-        ]
+        }
+
+        # Active connections for live event receiving, by connection id
+        self.event_connections: dict = {
+
+        }
+
+        # With multiple workers, the first connection on this worker may be an event connection.
+        self.add_connection(connection, event)
 
         # This is where all user settings will be stored.
         self.settings: dict = None
 
         # For determining when someone is 'away'
-        self.last_meaningful_action: int = round(time.time())
-
-        # Load the user state from the database.
-        self.load_state()
+        self.last_meaningful_action: float = time.time()
 
-        # Some internal settings that are extremely important
-        # We will expose them through our beautiful abstraction
-        self.friends: list = self.settings["!friends"]
-        self.blocked: list = self.settings["!blocked"]
-        self.friend_requests: list = self.settings["!friendreqs"]
-        
-        self.channels: list = self.settings["!channels"]
-        self.gchannels: list = self.settings["!gchannels"]
-        
-        self.subscriptions: list = self.settings["!subscriptionstome"]
-        self.subscriptionsto: list = self.settings["!subscriptionsto"]
-        
-        self.privatesettings: list = self.settings["!privatedsettings"]
-        self.privatewhitelist: dict = self.settings["!privatewhitelist"]
+        # The user state is loaded from the database afterwards, through
+        # the asynchronous load_state().
 
 
 
@@ -155,10 +202,7 @@ class User:
         if (private):
             self.privatesettings.append(setting)
         else:
-            if (setting not in self.privatesettings):
-                return
-
-            self.privatesettings.remove(setting)
+            self.privatesettings.discard(setting)
 
         # vv would be slow if done throughout an iteration multiple times
         #self.queue_state_change()
@@ -181,30 +225,50 @@ class User:
 
 
 
-    def queue_state_change(self):
-        if (not self.queued):
-            self.queued = True
-            self.users.userdb_queue.put(self)
+    def queue_state_change(self, *keys: str):
+        """Queue the settings named to be written to the database.
+        Naming none writes every setting.
+        """
 
+        keys = keys if keys != () else tuple(self.settings.keys())
 
-    def load_state(self):
+        self.changed.update(keys)
+        self.users.writer.mark(self.username, self)
+        self.users.graph.changed(self.username, self.settings, keys)
+
+
+    async def load_state(self):
         "Load the user state from the database store."
 
         # Because I am lazy, I named the database method .getsettings()
         # This does more than get actual Delegate Protocol user settings.
         # For example, it will also get user subscriptions.
 
-        udb = UserDb(self.instance, self.username)
-        self.fields = json.loads(udb.getsettings())
+        self.fields = codec.decode(await self.udb.getsettings())
 
-        self.settings = self.fields["settings"]
+        self.settings = load_relations(self.fields["settings"])
         #self.subscriptions = self.fields["subscriptions"]
 
+        # Some internal settings that are extremely important
+        # We will expose them through our beautiful abstraction
+        self.friends: OrderedSet = self.settings["!friends"]
+        self.blocked: OrderedSet = self.settings["!blocked"]
+        self.friend_requests: OrderedSet = self.settings["!friendreqs"]
+
+        self.channels: OrderedSet = self.settings["!channels"]
+        self.gchannels: OrderedSet = self.settings["!gchannels"]
+
+        self.subscriptions: OrderedSet = self.settings["!subscriptionstome"]
+        self.subscriptionsto: OrderedSet = self.settings["!subscriptionsto"]
+
+        self.privatesettings: OrderedSet = self.settings["!privatedsettings"]
+        self.privatewhitelist: dict = self.settings["!privatewhitelist"]
+
     def set_setting(self, setting: str, value: Any):
         "Change a user setting and push a database write onto the queue."
 
         self.settings[setting] = value
-        self.queue_state_change()
+        self.queue_state_change(setting)
 
 
     def set_settings(self, settings: dict):
@@ -217,29 +281,31 @@ class User:
         for key, value in settings.items():
             self.settings[key] = value
 
-        self.queue_state_change()
+        self.queue_state_change(*settings)
 
 
     def add_user_subscriber(self, username: str):
         "Add a user to the subscription list."
 
         self.subscriptions.append(username)
-        self.queue_state_change()
+        self.queue_state_change("!subscriptionstome")
 
     
-    def subscribe_to(self, username: str):
+    async def subscribe_to(self, username: str):
         "Subscribe to a user"
 
-        self.users.append_user_settings(username, "!subscribedto", [self.username])
+        await self.users.append_user_settings(username, "!subscriptionstome", [self.username])
         self.subscriptionsto.append(username)
-        self.queue_state_change()
+        self.queue_state_change("!subscriptionsto")
 
-    def unsubscribe_to(self, username: str):
+    async def unsubscribe_to(self, username: str):
         "Unsubscribe to a user"
 
-        self.users.append_user_settings(username, "!subscribedto", [self.username], remove = True)
-        self.subscriptionsto.append(username)
-        self.queue_state_change()
+        await self.users.append_user_settings(username, "!subscriptionstome", [self.username], remove = True)
+
+        self.subscriptionsto.discard(username)
+
+        self.queue_state_change("!subscriptionsto")
 
 
     def is_subscribedto(self, username: str) -> bool:
@@ -248,41 +314,30 @@ class User:
         return username in self.subscriptionsto
     
 
-    def has_me_blocked(self, username: str) -> bool:
+    async def has_me_blocked(self, username: str) -> bool:
         "Am I blocked by the user or not...?"
 
-        return self.username in self.users.get_user_settings(username)["!blocked"]
+        return await self.users.graph.has_blocked(username, self.username)
 
 
     async def special_settings_emit(self, special: dict):
         "Emit events to all subscribers when a special setting has changed."
 
-        for subscription in set(self.subscriptions + self.friends):
-
-            if ((user := self.users.get_user(subscription) == None)):
-                continue
-
-            await user.event("uspecial", {
-                "settings": special
-            })
+        await self.users.special_settings_emit(self.username, self.settings, special)
             
 
     async def send_friendreq(self, other: str, msg: str):
-        usrsettings: dict = self.users.get_user_settings(other)
+        usrsettings: dict = await self.users.get_user_settings(other)
 
         # Detect if such a friend request already exists
         if (other in usrsettings["!friendreqs"]):
             raise KeyError("Friend request already exists.")
 
-        self.users.append_user_settings(other, "!friendreqs", [self.username])
+        await self.users.append_user_settings(other, "!friendreqs", [self.username])
 
 
         # Send the friend request event to the other user, only if they are online.
-        user = None
-        if ((user := self.users.get_user(other)) == None):
-            return
-
-        await user.event("friend", {
+        await self.users.send_event(other, "friend", {
             "username": self.username,
             "message": msg
         })
@@ -298,17 +353,12 @@ class User:
         # If the friend request is accepted, add each other to friends list.
         if (accept):
             self.friends.append(username)
-            user = self.users.append_user_settings(username, "!friends", self.username)
-            self.queue_state_change()
+            user = await self.users.append_user_settings(username, "!friends", [self.username])
+            self.queue_state_change("!friends")
 
         # If notifying is turned on, notify them of whether it was accepted or not.
         if (notify):
-            user = self.users.get_user(username)
-            if (user == None):
-                return
-
-            # Send the event.
-            await user.event("frequest", {
+            await self.users.send_event(username, "frequest", {
                 "username": self.username,
                 "accepted": accept
             })
@@ -330,39 +380,39 @@ class User:
         "Adds a connection to the pool of connections already associated with this user."
 
         if (event):
-            self.event_connections.append(connection)
+            self.event_connections[connection.id] = connection
         else:
-            self.connections.append(connection)
+            self.connections[connection.id] = connection
+
+    def remove_connection(self, connection):
+        "Removes a connection, whichever kind it is."
+
+        self.connections.pop(connection.id, None)
+        self.event_connections.pop(connection.id, None)
 
     def all_connections(self) -> list:
         "Returns a combined list full of the normal and event connections."
 
-        return self.connections + self.event_connections
+        return list(self.connections.values()) + list(self.event_connections.values())
 
-    async def sendall(self, msg):
-        "Send a WebSockets message to all event parties. [DO NOT USE ALONE!]"
+    async def sendall(self, msg, key: str = None):
+        "Queue a WebSockets message for all event parties. [DO NOT USE ALONE!]"
+
+        # Dead connections are logged off by the server once their socket closes.
+        for conn in self.event_connections.values():
+            conn.push(msg, key)
 
-        for conn in self.event_connections:
-            try:
-                await conn.websocket.send(msg)
-            except Exception as err:
-                await self.users.user_logoff(conn, self.username, event = True)
-                
 
     async def event(self, name, body, connid = None):
         "Send an event to all event parties."
 
-        result = {
-            "event": name,
-        }
-        
-        result.update(body)
+        frame: str = form_event(name, body)
 
         if (connid == None):
-            await self.sendall(json.dumps(result))
+            await self.sendall(frame)
 
         else:
-            await self.connections[connid].send(json.dumps(result))
+            await self.connections[connid].send(frame)
 
 
     async def send_message(self, to, message: messages.Message):
@@ -384,7 +434,7 @@ class User:
     def __str__(self) -> str:
         "Convert User object to JSON state that goes into the database"
 
-        return json.dumps(self.get_state())
+        return codec.encode_text(self.get_state())
 
 
 
@@ -394,144 +444,357 @@ class Users:
         self.instance = instance
         self.users: dict = {}
 
-        # Perhaps a bit inefficient
-        self.userdb_queue: queue.Queue = queue.Queue()
-        self.userdb_queue_t = threading.Thread(
-            target = user_database_queue, 
-            args = (self.userdb_queue,)
-        ).start()
+        # Changed user state is written to the database in batches.
+        self.writer: UserStateWriter = UserStateWriter(instance)
 
-        self.settings_cache = {
+        metrics.online_users.track(lambda: len(self.users))
+        metrics.connections.track(
+            lambda: sum(len(user.connections) + len(user.event_connections) for user in self.users.values())
+        )
 
-        }
+        # Who blocked, befriended or shares a channel with whom.
+        self.graph: graph.SocialGraph = graph.SocialGraph(self)
+
+        # Settings of offline users, which every write path keeps up to date.
+        self.settings_cache: cache.LRUCache = cache.LRUCache(
+            "settings", Caching.SettingsSize, Caching.SettingsTTL
+        )
+
+        # The users whose settings were written while settings were being read, one set for every
+        # read underway. What such a read brought back may predate the write, so it is not cached.
+        self.reads: list = []
 
         self.tfa_cache = {
 
         }
 
-        #asyncio.get_event_loop().create_task(self.away_checker())
+        # Special setting changes waiting to be emitted, merged per user: username -> [settings, changes]
+        self.pending_specials: dict = {}
+        self.specials_t: asyncio.Task = None
+        self.special_window: float = Events.SpecialWindow
+
+        # Moves idle users to Away and then Offline.
+        self.presence: presence.PresenceEngine = presence.PresenceEngine(self)
 
 
-    async def away_checker(self):
-        "Function which checks which users have gone away or not, dependent on settings."
+    def start(self):
+        "Start the background tasks. Must be called from within the running event loop."
 
-        while True:
-            for user in self.users:
-                # If they have been inactive for a certain amount of time...
-                if ((round(time.time()) - user.last_meaningful_action) 
-                    >= UserSettings.UserAwayTime):
+        self.writer.start()
+        self.presence.start()
 
-                    await self.change_user_settings(user.username, {
-                        "$status": UserStatuses.Away
-                    }, special = True)
 
-                await asyncio.sleep(1)
+    async def stop(self):
+        "Write out all changed user state. Called on shutdown."
 
-            await asyncio.sleep(5 * MINUTE)
+        self.presence.stop()
+        await self.writer.stop()
 
 
     def put_in_notifications(self, username, data: dict):
         pass
 
 
-    async def send_event(self, username, event, body):
+    async def send_event(self, username, event, body, routed = False):
+        "Send an event to a user, wherever they are connected."
+
         if (username in self.users):
             user: User = self.users[username]
             await user.event(event, body)
 
+        # They are connected to other workers, so let the broker deliver it there.
+        # Events that came from the broker are never routed again.
+        broker = self.instance.broker
+        if (not routed and broker != None and broker.online_elsewhere(username)):
+            broker.route(username, event, body)
+
         # Add code for the inbox here.
 
-    def two_users_in_channel(self, username1, username2) -> bool:
+    def broadcast_frame(self, usernames, frame: str, key: str = None) -> int:
+        """Queue an already encoded frame on the event connections of every online user given.
+        Returns the number of sockets it was queued for.
+        """
+
+        sent: int = 0
+
+        for username in usernames:
+            if ((user := self.users.get(username)) == None):
+                continue
+
+            for conn in user.event_connections.values():
+                conn.push(frame, key)
+                sent += 1
+
+        return sent
+
+
+    async def broadcast_event(self, usernames, event: str, body: dict, key: str = None) -> int:
+        """Send one event to many users, encoding it only once.
+        Returns the number of sockets on this worker that it was sent to.
+        """
+
+        frame: str = form_event(event, body)
+        sent: int = self.broadcast_frame(usernames, frame, key)
+        metrics.fanout_size.observe(sent)
+
+        # Users on other workers receive the same frame through the broker.
+        broker = self.instance.broker
+        if (broker != None):
+            elsewhere = [username for username in usernames if broker.online_elsewhere(username)]
+
+            if (elsewhere != []):
+                broker.route_frame(elsewhere, frame, key)
+
+        return sent
+
+    def held_user(self, username) -> User:
+        """A user whose state is in memory: online, or offline with their latest state
+        still waiting to be written or being written. Their state is newer than the database's, so it must be used instead.
+        """
+
+        if ((user := self.users.get(username)) != None):
+            return user
+
+        return self.writer.held(username)
+
+
+    async def special_settings_emit(self, username: str, usersettings: dict, special: dict):
+        """Emit events to all subscribers and friends of a user when a special setting of theirs has changed.
+        Changes within Events.SpecialWindow of each other are merged into one event, the latest value winning,
+        so a user flapping their connection or status sends one event rather than a storm of them.
+        """
+
+        if (self.special_window <= 0):
+            await self.broadcast_specials(username, usersettings, special)
+            return
+
+        if ((pending := self.pending_specials.get(username)) == None):
+            self.pending_specials[username] = [usersettings, dict(special)]
+
+        else:
+            # The latest settings decide who hears about it.
+            pending[0] = usersettings
+            pending[1].update(special)
+
+        if (self.specials_t == None):
+            self.specials_t = asyncio.create_task(self.emit_specials_later())
+
+
+    async def emit_specials_later(self):
+        "Wait out the window, then emit every merged change."
+
+        await asyncio.sleep(self.special_window)
+
+        pending: dict = self.pending_specials
+        self.pending_specials = {}
+        self.specials_t = None
+
+        for username, (usersettings, special) in pending.items():
+            await self.broadcast_specials(username, usersettings, special)
+
+
+    async def broadcast_specials(self, username: str, usersettings: dict, special: dict):
+        # A later change of exactly the same settings supersedes one that is still queued.
+        key: str = "uspecial:" + username + ":" + ",".join(sorted(special))
+
+        await self.broadcast_event(usersettings["!subscriptionstome"] | usersettings["!friends"], "uspecial", {
+            "settings": special
+        }, key = key)
+
+
+    async def two_users_in_channel(self, username1, username2) -> bool:
         "Are two users within mutual channels?"
 
-        channels1 = set(self.get_user_settings(username1)["!channels"])
-        channels2 = set(self.get_user_settings(username2)["!channels"])
+        return await self.graph.share_channel(username1, username2)
 
-        return channels1.intersection(channels2) != set()
 
+    async def change_user_settings(self, username: str, settings: dict, special = False, routed = False):
+        "Modify the user settings of any given user (whether they are online or not, and wherever)"
 
-    async def change_user_settings(self, username: str, settings: dict, special = False):
-        "Modify the user settings of any given user (whether they are online or not)"
+        user: User = self.held_user(username)
 
-        # If an online user
-        if (username in self.users):
-            self.users[username].set_settings(settings)
+        # They are online on other workers, which apply it themselves. Changes routed here are not routed again.
+        if (not routed and self.route_change(username, {"set": settings}, special and user == None) and user == None):
             return
 
-        # Going to have to set it via database now.
-        udb: UserDb = UserDb(self.instance, username)
-        if (not udb.exists()):
-            raise Exception("The user should exist???!?!?!?!?!?!?!?!")
+        # If an online user (or one whose state is still in memory)
+        if (user != None):
+            user.set_settings(settings)
 
-        
-        # Get existing settings so that we can modify them in place.
-        sets: dict = self.get_user_settings(username)
-        sets.update(settings)
+            if (special):
+                await user.special_settings_emit(settings)
 
-        # Set them.
-        udb.setsettings(sets)
+            return
+
+        # Going to have to set it via database now; only the settings given are written.
+        udb: UserDb = UserDb(self.instance, username)
+        usersettings: dict = await udb.patch_settings(settings)
+
+        self.settings_written(username, usersettings, settings)
 
         if (special):
-            await self.users[username].special_settings_emit(settings)
+            await self.special_settings_emit(username, usersettings, settings)
 
 
-    def append_user_settings(self, username: str, setting: str, values: list, remove: bool = False):
+    async def append_user_settings(self, username: str, setting: str, values: list, remove: bool = False, routed = False):
         "Add or remove (append negative) vector values from settings, whether the user is online or not"
 
-        # They're online
-        if (username in self.users):
+        def append(vector: OrderedSet) -> OrderedSet:
             for value in values:
                 if (remove):
-                    self.users[username].settings[setting].remove(value)
+                    vector.discard(value)
                     continue
 
-                self.users[username].settings[setting].append(value)
+                vector.add(value)
+
+            return vector
+
+        user: User = self.held_user(username)
 
+        # They are online on other workers, which apply it themselves.
+        change: dict = {"append": setting, "values": list(values), "remove": remove}
+        if (not routed and self.route_change(username, change, False) and user == None):
+            return
+
+        # They're online
+        if (user != None):
+            append(user.settings[setting])
+            user.queue_state_change(setting)
             return
 
-        # Have to use the database now.
+        # Have to use the database now. Only this one setting is read and written.
         udb: UserDb = UserDb(self.instance, username)
-        if (not udb.exists()):
-            raise Exception("Why doesn't the user exist?!?!??!?!?!?!")
+        usersettings: dict = await udb.modify_setting(setting, lambda vector: append(OrderedSet(vector)))
 
-        settings: dict = udb.getsettings()["settings"]
+        self.settings_written(username, usersettings, [setting])
+
+
+    def route_change(self, username: str, change: dict, special: bool) -> bool:
+        """Hand a change to the settings of a user to every other worker they are online on, so that it
+        is applied to the state held there rather than overwritten once that is written. Only the first
+        emits it, if special. Returns whether there were any.
+        """
+
+        broker = self.instance.broker
+
+        if (broker == None or not broker.online_elsewhere(username)):
+            return False
+
+        for index, worker in enumerate(broker.holders(username)):
+            broker.mutate(worker, username, {**change, "special": special and index == 0})
+
+        return True
+
+    async def apply_change(self, username: str, change: dict):
+        "Apply a change routed here by another worker."
+
+        if ("set" in change):
+            await self.change_user_settings(username, load_relations(change["set"]), special = change["special"], routed = True)
+        else:
+            await self.append_user_settings(username, change["append"], change["values"], change["remove"], routed = True)
 
-        for value in values:
-            if (remove):
-                settings[setting].remove(value)
-                continue
 
-            settings[setting].append(value)
+    def settings_written(self, username: str, usersettings: dict, keys):
+        "The settings named in keys of an offline user were just written to the database."
 
+        self.settings_cache.update(username, usersettings)
+        self.graph.changed(username, usersettings, keys)
 
-    def get_user_settings(self, username: str) -> dict:
+        for changed in self.reads:
+            changed.add(username)
+
+        # Whatever the other workers cached of them is out of date.
+        if (self.instance.broker != None):
+            self.instance.broker.written(username)
+
+    def forget_settings(self, username: str):
+        "The settings of a user were written by another worker. Told by the broker."
+
+        self.settings_cache.invalidate(username)
+        self.graph.forget(username)
+
+        for changed in self.reads:
+            changed.add(username)
+
+        for changed in self.graph.reads:
+            changed.add(username)
+
+
+    async def get_user_settings(self, username: str) -> dict:
         "Get the user account settings (protocol-defined settings) whether or not they're online"
 
         # An online user
-        if (username in self.users):
-            return self.users[username].settings
+        if ((user := self.held_user(username)) != None):
+            return user.settings
 
         # Returned cached user settings state.
-        if (username in self.settings_cache):
-            return self.settings_cache[username]
+        if ((cached := self.settings_cache.get(username)) != None):
+            return cached
 
-        # Gotta ask the database, now. 
-        u: UserDb = UserDb(self.instance, username)
+        # Gotta ask the database, now. A user that does not exist simply comes back without settings.
+        usersettings: dict = (await self.get_many_user_settings([username])).get(username)
 
-        if (not u.exists()):
+        if (usersettings == None):
             raise Exception("Uhh... the user does not exist????")
 
-        self.settings_cache[username] = json.loads(u.getsettings())["settings"]
-        return self.settings_cache[username]
+        return usersettings
+
+
+    async def get_many_user_settings(self, usernames) -> dict:
+        """Get the settings of many users at once: username -> settings.
+        Whatever is not in memory or cached is fetched with a single query.
+        Users that do not exist are left out.
+        """
+
+        result: dict = {}
+        missing: list = []
+
+        # Each name once, however often it was given.
+        for username in dict.fromkeys(usernames):
+            if ((user := self.held_user(username)) != None):
+                result[username] = user.settings
+
+            elif ((cached := self.settings_cache.get(username)) != None):
+                result[username] = cached
+
+            else:
+                missing.append(username)
+
+        if (missing == []):
+            return result
+
+        changed: set = set()
+        self.reads.append(changed)
+
+        try:
+            states: dict = await UserDb.getsettings_many(self.instance, missing)
+
+        finally:
+            self.reads.remove(changed)
+
+        for username, state in states.items():
+            # They may have signed in while the query ran, in which case theirs is the newer state.
+            if ((user := self.held_user(username)) != None):
+                result[username] = user.settings
+                continue
+
+            usersettings: dict = load_relations(codec.decode(state)["settings"])
+            result[username] = usersettings
+
+            # Written while the query ran: the cache has to wait for a read that comes after.
+            if (username not in changed):
+                self.settings_cache.put(username, usersettings)
+
+        return result
 
     
-    def has_2fa(self, username: str) -> bool:
-        return self.get_user_settings(username)["&2fa"]
+    async def has_2fa(self, username: str) -> bool:
+        return (await self.get_user_settings(username))["&2fa"]
 
 
-    def verify_2fa(self, username: str, code: str) -> bool:
+    async def verify_2fa(self, username: str, code: str) -> bool:
         udb: UserDb = UserDb(self.instance, username)
-        secret_key = udb.get_tfa()
+        secret_key = await udb.get_tfa()
 
         #print(secret_key)
 
@@ -546,10 +809,32 @@ class Users:
 
         if (username not in self.users):
             # Delete the cached settings once the user comes online.
-            if (username in self.settings_cache):
-                del self.settings_cache[username]
+            self.settings_cache.invalidate(username)
 
-            self.users[username] = User(username, connection, self.instance, self)
+            # They only just went offline and their last state is still waiting to be written.
+            # Wait for it to be written, even if that is already underway.
+            await self.writer.settle(username)
+
+            user: User = User(username, connection, self.instance, self, event = event)
+            await user.load_state()
+
+            # Another connection of theirs signed in while the state was loading.
+            if (username in self.users):
+                return self.add_connection(self.users[username], connection, event)
+
+            self.users[username] = user
+            self.presence.watch(user)
+
+            if (event):
+                self.instance.channels.user_listening(username, user.channels)
+
+            # Another worker has already declared them as online.
+            broker = self.instance.broker
+            if (broker != None):
+                broker.announce(username, True)
+
+                if (broker.online_elsewhere(username)):
+                    return user
 
             # Declare that they are online through the $status user setting.
             await self.change_user_settings(username, {
@@ -559,8 +844,20 @@ class Users:
             return self.users[username]
 
 
-        self.users[username].add_connection(connection, event)
-        return self.users[username]
+        return self.add_connection(self.users[username], connection, event)
+
+
+    def add_connection(self, user: User, connection, event: bool) -> User:
+        "Add another connection to a user who is already online."
+
+        listening: bool = user.event_connections != {}
+        user.add_connection(connection, event)
+
+        # Their first event connection: their channels can now reach them.
+        if (event and not listening):
+            self.instance.channels.user_listening(user.username, user.channels)
+
+        return user
 
     def get_user(self, username) -> User:
         "Obtain a currently connected user. If they are not currently connected, return None."
@@ -571,79 +868,75 @@ class Users:
         return self.users[username]
 
 
-    def user_exists(self, username) -> bool:
+    async def user_exists(self, username) -> bool:
         "An efficient way to check if a username exists. "
 
-        if (username in self.users):
+        # Anyone whose state is in memory or cached exists.
+        if (self.held_user(username) != None or username in self.settings_cache):
             return True
 
-        udb: UserDb = UserDb(username)
-        return udb.exists()
+        udb: UserDb = UserDb(self.instance, username)
+        return await udb.exists()
 
 
     def user_online(self, username) -> bool:
-        "Is the user online?"
+        "Is the user online? (on any worker)"
 
-        return (username in self.users)
+        if (username in self.users):
+            return True
 
-    async def user_logoff(self, connection, username, consensual = False, event = False):
-        "Log a user connection off and automatically deallocate memory if needed."
+        return self.instance.broker != None and self.instance.broker.online_elsewhere(username)
 
-        # WARNING: This section is extremely buggy.
+    async def user_logoff(self, connection, username, consensual = False):
+        "Log a user connection off, and the user as a whole once it was their last connection."
 
-        if (username not in self.users.keys()):
+        if ((user := self.users.get(username)) == None):
             raise KeyError("User is not online??!?!?!?!?!?!?!?")
 
         # Send a successful logout code on a consensual logout.
         if (consensual):
             await connection.code(UserCodes.Success.Logout)
-        
-        if (not event):
-            self.users[username].connections.remove(connection)
-
-        else:
-            self.users[username].event_connections.remove(connection)
-
 
-        # Remove dead connections.
-        for connid, conn in enumerate(self.users[username].connections):
-            if (not conn.websocket.open):
-                self.users[username].connections.pop(connid)
+        listening: bool = user.event_connections != {}
+        user.remove_connection(connection)
 
-        # Remove dead event connections
-        for connid, conn in enumerate(self.users[username].event_connections):
-            if (not conn.websocket.open):
-                self.users[username].event_connections.pop(connid)
-
-
-        #self.users[username].connections.remove(connection)
-        #print([x._identity() for x in self.users[username].connections])
+        # Their last event connection: leave the online indexes of their channels.
+        if (listening and user.event_connections == {}):
+            self.instance.channels.user_not_listening(username, user.channels)
 
+        if (user.connections != {} or user.event_connections != {}):
+            return
 
         # If there are no more connections in total, mark the user's status as offline
         # then declare it a special setting, so that it will be sent as an event
         # to all subscribers and friends.
-        if ((self.users[username].connections + self.users[username].event_connections) == []):
+        broker = self.instance.broker
+
+        # They are still online through another worker.
+        if (broker == None or not broker.online_elsewhere(username)):
             await self.change_user_settings(username, {
                 "$status": UserStatuses.Offline
             }, special = True)
 
-            del self.users[username]
-        
+        del self.users[username]
+        self.presence.forget(username)
 
-    def are_friends(self, username1: str, username2: str) -> bool:
-        friends: list = self.get_user_settings(username1)["!friends"]
+        if (broker != None):
+            broker.announce(username, False)
+        
 
-        return (username2 in friends)
+    async def are_friends(self, username1: str, username2: str) -> bool:
+        return await self.graph.are_friends(username1, username2)
 
-    def is_private(self, username: str, username2: str, setting: str) -> bool:
-        private_settings: list = self.get_user_settings(username)["!privatedsettings"]
+    async def is_private(self, username: str, username2: str, setting: str) -> bool:
+        user_settings: dict = await self.get_user_settings(username)
+        private_settings: OrderedSet = user_settings["!privatedsettings"]
         
         # If it's not within the private settings, then it isn't private.
         if (setting not in private_settings):
             return False
 
-        private_whitelist: dict = self.get_user_settings(username)["!privatewhitelist"]
+        private_whitelist: dict = user_settings["!privatewhitelist"]
 
         # Does not have a whitelist exception
         if (setting not in private_whitelist):
@@ -656,7 +949,7 @@ class Users:
         # Whitelist setting of null/None
         # means they must be friends for the whitelist to apply.
         if (private_whitelist[setting] == None):
-            if (self.are_friends(username, username2)):
+            if (await self.are_friends(username, username2)):
                 return False
 
 
@@ -664,77 +957,160 @@ class Users:
 
         
 
+# Merges a JSON object of changed settings into the stored settings, so that
+# only the changed ones are sent and everything else is left as it is.
+patch_settings_query = (
+    "UPDATE Users SET settings = jsonb_set(settings, '{settings}', (settings->'settings') || %s::jsonb) "
+    "WHERE username = %s RETURNING (settings->'settings')::text;"
+)
+
+
 class UserDb:
     def __init__(self, instance, username: str):
         self.instance = instance
         self.username: str = username
-        self.database: psycopg2.cursor = instance.cursor
+        self.database: database.Database = instance.db
 
-    def exists(self) -> bool:
+    @metrics.timed(metrics.sql_seconds)
+    async def exists(self) -> bool:
         "Does the user exist?"
 
-        self.database.execute("SELECT username FROM Users WHERE username = %s;", (self.username,))
-        return self.database.fetchone() != None
+        row = await self.database.fetchone("SELECT username FROM Users WHERE username = %s;", (self.username,))
+        return row != None
+
+    async def register(self, password, bot = False) -> bool:
+        """Register the username, returning False if someone else registered it first.
+        Raises hashing.Saturated when too many hashes are waiting.
+        """
 
-    def register(self, password, bot = False):
-        "Register the username"
+        return await self.insert(await self.instance.hasher.hash(password), bot)
 
+    @metrics.timed(metrics.sql_seconds)
+    async def insert(self, passhash: str, bot: bool) -> bool:
         creation = round(time.time())
 
-        self.database.execute(
-            "INSERT INTO Users (username, created, settings, passhash) VALUES (%s, %s, %s, %s);",
+        # The primary key settles two registrations racing for the same name.
+        row = await self.database.fetchone(
+            "INSERT INTO Users (username, created, settings, passhash) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT DO NOTHING RETURNING username;",
             (
                 self.username,
                 creation,
-                json.dumps(generate_user_state(creation, bot)),
-                passlib.hash.argon2.hash(password)
+                codec.encode_text(generate_user_state(creation, bot)),
+                passhash
             )
         )
 
-        self.instance.database.commit()
+        return row != None
     
-    def verify(self, password, tfa = ""):
-        "Verify the login credentials"
+    async def verify(self, password, tfa = ""):
+        "Verify the login credentials. Raises hashing.Saturated when too many are waiting."
 
-        self.database.execute("SELECT passhash FROM Users WHERE username = %s;", (self.username,))
-        passhash = self.database.fetchone()[0]
+        return await self.instance.hasher.verify(password, await self.get_passhash())
 
-        return passlib.hash.argon2.verify(password, passhash)
+    @metrics.timed(metrics.sql_seconds)
+    async def get_passhash(self) -> str:
+        row = await self.database.fetchone("SELECT passhash FROM Users WHERE username = %s;", (self.username,))
+        return row[0]
 
-    def getsettings(self) -> str:
+    @metrics.timed(metrics.sql_seconds)
+    async def getsettings(self) -> str:
         "Get the user settings"
 
-        self.database.execute("SELECT settings FROM Users WHERE username = %s;", (self.username,))
-        settings = self.database.fetchone()[0]
+        # As text, so that the codec decodes it rather than psycopg2.
+        row = await self.database.fetchone("SELECT settings::text FROM Users WHERE username = %s;", (self.username,))
+        settings = row[0]
         return settings
 
-    def setsettings(self, settings: dict):
+    @staticmethod
+    @metrics.timed(metrics.sql_seconds)
+    async def getsettings_many(instance, usernames: list) -> dict:
+        "Get the state of many users with one query: username -> state text. Users that do not exist are left out."
+
+        rows = await instance.db.fetchall(
+            "SELECT username, settings::text FROM Users WHERE username = ANY(%s);", (list(usernames),)
+        )
+
+        return dict(rows)
+
+    @metrics.timed(metrics.sql_seconds)
+    async def setsettings(self, settings: dict):
         "Set the user settings"
 
-        self.database.execute("UPDATE Users SET settings = %s WHERE username = %s;", (
-            json.dumps(settings),
+        await self.database.execute("UPDATE Users SET settings = %s WHERE username = %s;", (
+            codec.encode_text(settings),
             self.username
         ))
 
-        self.instance.database.commit()
+
+    @metrics.timed(metrics.sql_seconds)
+    async def patch_settings(self, patch: dict) -> dict:
+        "Change only the settings in patch, leaving the others untouched. Returns all of the new settings."
+
+        row = await self.database.fetchone(patch_settings_query, (codec.encode_text(patch), self.username))
+
+        if (row == None):
+            raise KeyError(f"The user {self.username} does not exist.")
+
+        return load_relations(codec.decode(row[0]))
+
+
+    @metrics.timed(metrics.sql_seconds)
+    async def modify_setting(self, setting: str, function) -> dict:
+        """Change one setting to function(value), which may modify value in place but has to return it.
+        The row stays locked from reading to writing, so two changes cannot overwrite each other.
+        Returns all of the new settings.
+        """
+
+        def modify(cursor) -> dict:
+            cursor.execute(
+                "SELECT (settings->'settings'->%s)::text FROM Users WHERE username = %s FOR UPDATE;",
+                (setting, self.username)
+            )
+
+            if ((row := cursor.fetchone()) == None):
+                raise KeyError(f"The user {self.username} does not exist.")
+
+            # A setting the user does not have yet (NULL), or that is null, starts out as an empty list.
+            current = None if row[0] == None else codec.decode(row[0])
+            value = function([] if current == None else current)
+
+            cursor.execute(patch_settings_query, (codec.encode_text({setting: value}), self.username))
+            return load_relations(codec.decode(cursor.fetchone()[0]))
+
+        return await self.database.run(modify)
+
+
+    @staticmethod
+    @metrics.timed(metrics.sql_seconds)
+    async def patch_settings_many(instance, usernames: list, patches: list):
+        "Patch the settings of many users at once, with one statement. patches are already encoded."
+
+        await instance.db.execute(
+            "UPDATE Users SET settings = jsonb_set(settings, '{settings}', (settings->'settings') || batch.patch::jsonb) "
+            "FROM (SELECT UNNEST(%s::text[]) AS username, UNNEST(%s::text[]) AS patch) AS batch "
+            "WHERE Users.username = batch.username;",
+            (usernames, patches)
+        )
 
 
-    def get_tfa(self) -> str:
+    @metrics.timed(metrics.sql_seconds)
+    async def get_tfa(self) -> str:
         "Receive the 2fa secret key that the user has."
 
-        self.database.execute("SELECT tfa FROM Users WHERE username = %s;", (self.username,))
-        return self.database.fetchone()[0]
+        row = await self.database.fetchone("SELECT tfa FROM Users WHERE username = %s;", (self.username,))
+        return row[0]
 
 
-    def update_2fa(self) -> str:
+    @metrics.timed(metrics.sql_seconds)
+    async def update_2fa(self) -> str:
         "Add or change TOPT 2FA onto the user. Returns the secret key generated"
 
         tfa_secret = pyotp.random_base32()
-        self.database.execute("UPDATE Users SET tfa = %s WHERE username = %s;", (
+        await self.database.execute("UPDATE Users SET tfa = %s WHERE username = %s;", (
             tfa_secret,
             self.username
         ))
 
-        self.instance.database.commit()
         return tfa_secret
 
@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+
+import metrics
+from util import *
+
+
+class WriteBehind:
+    def __init__(self, name: str, interval: float, batch_size: int,
+                 flush_seconds: metrics.Histogram, flush_size: metrics.Histogram):
+        """Writes changed objects to the database behind their backs.
+        An object that changes many times between two flushes is only written once. Every interval,
+        or as soon as batch_size objects are waiting, they are handed to write() batch_size at a time.
+        Subclasses implement write(), which should write one batch in a single transaction.
+        """
+
+        self.name: str = name
+        self.interval: float = interval
+        self.batch_size: int = batch_size
+
+        self.flush_seconds: metrics.Histogram = flush_seconds
+        self.flush_size: metrics.Histogram = flush_size
+
+        # Objects waiting to be written, by key. A dictionary keeps them in the order
+        # they first changed and makes queueing the same object again free.
+        self.dirty: dict = {}
+
+        # Objects taken out of dirty whose write has not finished yet, by key. Until it has,
+        # the database may still hold their older state, so they are as good as dirty.
+        self.writing: dict = {}
+
+        # One batch written at a time, so that a newer state of an object can never be written
+        # before an older one. Batches take turns with settle(), which waits for at most one of them.
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+        # Set when enough objects are waiting that the next flush should not wait for the interval.
+        self.full: asyncio.Event = asyncio.Event()
+        self.task: asyncio.Task = None
+
+
+    def mark(self, key, value):
+        "Queue an object to be written."
+
+        self.dirty[key] = value
+
+        if (len(self.dirty) >= self.batch_size):
+            self.full.set()
+
+
+    def held(self, key):
+        "The object queued or being written under a key, or None. Its state is newer than the database's."
+
+        if ((value := self.dirty.get(key)) != None):
+            return value
+
+        return self.writing.get(key)
+
+
+    async def settle(self, key):
+        """Wait until whatever is queued or being written under a key is in the database.
+        Only the batch already underway is waited for; an object still queued is written on its own.
+        """
+
+        if (key not in self.dirty and key not in self.writing):
+            return
+
+        async with self.lock:
+            # Nothing is being written while the lock is held, so only the queued state is left.
+            if (key in self.dirty):
+                await self.flush_batch([key])
+
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+
+    async def run(self):
+        "Flush every interval, or sooner once a batch has filled up."
+
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self.full.clear()
+
+            try:
+                await self.flush()
+
+            # Keep on writing; the objects that failed are queued again by flush().
+            except Exception as error:
+                eprint(f"Error writing {self.name} state: {error}")
+
+
+    async def flush(self):
+        "Write every waiting object, batch_size at a time."
+
+        while self.dirty != {}:
+            async with self.lock:
+                # settle() may have written the last of them while this waited.
+                if (self.dirty != {}):
+                    await self.flush_batch()
+
+
+    async def flush_batch(self, keys: list = None):
+        "Write the given keys, or the batch_size that have waited the longest. Hold the lock."
+
+        if (keys == None):
+            keys = list(itertools.islice(self.dirty, self.batch_size))
+
+        batch: list = [self.dirty.pop(key) for key in keys]
+
+        self.writing.update(zip(keys, batch))
+        started: float = metrics.now()
+
+        try:
+            await self.write(batch)
+
+        except Exception:
+            # Put them back, unless they were queued again in the meantime.
+            for key, value in zip(keys, batch):
+                self.dirty.setdefault(key, value)
+
+            raise
+
+        finally:
+            for key in keys:
+                self.writing.pop(key, None)
+
+        self.flush_seconds.observe_since(started)
+        self.flush_size.observe(len(batch))
+
+
+    async def write(self, batch: list):
+        """Write a batch of objects. If it raises, the batch is queued again, so it has to
+        leave the objects as they were, still knowing what changed.
+        """
+
+        raise NotImplementedError
+
+
+    async def stop(self):
+        "Stop flushing periodically, then write whatever is still waiting."
+
+        if (self.task != None):
+            self.task.cancel()
+            self.task = None
+
+        await self.flush()